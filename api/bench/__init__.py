@@ -0,0 +1,12 @@
+'''
+In-process benchmarks for the chat backend.
+
+Each module is runnable on its own, e.g.
+
+    python -m bench.consumer --clients 500
+
+and prints a JSON report (or writes it with --output). Two saved reports
+of the same benchmark can be checked for regressions:
+
+    python -m bench.compare before.json after.json
+'''
@@ -0,0 +1,283 @@
+'''
+Multi-node message throughput: N Daphne workers over a sharded channel layer.
+
+Starts --redis local redis-server processes as the channel layer shards;
+the first also holds the shared chat state. Then, for each count in
+--nodes, it starts that many Daphne workers on consecutive ports. Every
+worker has its own CHAT_WORKER_ID and runs write-behind over one SQLite
+(WAL) file.
+
+Client pairs connect over real websockets with JWTs. The sender goes to
+one worker and the recipient to the next, so every message crosses nodes
+through the layer. Each sender fires R message.send frames, waiting for
+its own copy of each one. The report gives, per worker count:
+
+- messages per second delivered to recipients
+- send -> recipient latency
+
+Needs redis-server and daphne on PATH. One machine is shared by every
+worker, Redis and the clients, so expect scaling to flatten once it runs
+out of cores.
+'''
+import asyncio
+import base64
+import json
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import django
+import redis
+
+from bench import harness
+
+API_DIR = Path(__file__).resolve().parent.parent
+
+
+class Client:
+    '''
+    Just enough of a websocket client for JSON text frames, on asyncio
+    streams. (autobahn's asyncio client can't share a process with Daphne's
+    Twisted import.)
+    '''
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.frames = asyncio.Queue()
+        self.task = asyncio.create_task(self.read())
+
+    @classmethod
+    async def open(cls, port, path):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write((
+            f'GET {path} HTTP/1.1\r\n'
+            f'Host: 127.0.0.1:{port}\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key}\r\n'
+            'Sec-WebSocket-Version: 13\r\n'
+            'Origin: http://127.0.0.1\r\n'
+            '\r\n'
+        ).encode())
+        response = await reader.readuntil(b'\r\n\r\n')
+        if not response.startswith(b'HTTP/1.1 101'):
+            writer.close()
+            raise RuntimeError(f'websocket refused: {response.splitlines()[0].decode()}')
+        return cls(reader, writer)
+
+    def send_frame(self, opcode, payload):
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+        masked = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+        self.writer.write(header + mask + masked)
+
+    def send_json(self, data):
+        self.send_frame(0x1, json.dumps(data).encode())
+
+    async def read(self):
+        # Server frames are unmasked; Daphne doesn't fragment text frames
+        while True:
+            first, second = await self.reader.readexactly(2)
+            length = second & 0x7F
+            if length == 126:
+                length, = struct.unpack('!H', await self.reader.readexactly(2))
+            elif length == 127:
+                length, = struct.unpack('!Q', await self.reader.readexactly(8))
+            payload = await self.reader.readexactly(length)
+            opcode = first & 0x0F
+            if opcode == 0x1:
+                self.frames.put_nowait(json.loads(payload))
+            elif opcode == 0x9:
+                self.send_frame(0xA, payload)
+            elif opcode == 0x8:
+                return
+
+    async def receive_source(self, source, timeout=30):
+        # Skip unrelated pushes (presence, offline) until the expected one
+        while True:
+            frame = await asyncio.wait_for(self.frames.get(), timeout)
+            if frame.get('source') == source:
+                return frame
+
+    async def close(self):
+        self.send_frame(0x8, struct.pack('!H', 1000))
+        self.task.cancel()
+        self.writer.close()
+
+
+async def open_client(port, token):
+    return await Client.open(port, f'/chat/?token={token}')
+
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'process on port {port} exited with {process.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'nothing listening on port {port}')
+
+
+def start_redis(port, directory):
+    process = subprocess.Popen(
+        ['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no', '--dir', directory],
+        stdout=subprocess.DEVNULL,
+    )
+    wait_for_port(port, process)
+    return process
+
+
+def start_workers(count, base_port, env, log):
+    workers = []
+    for index in range(count):
+        port = base_port + index
+        process = subprocess.Popen(
+            ['daphne', '-b', '127.0.0.1', '-p', str(port), 'core.asgi:application'],
+            cwd=API_DIR,
+            env={**os.environ, **env, 'CHAT_WORKER_ID': str(index)},
+            stdout=log,
+            stderr=log,
+        )
+        workers.append((port, process))
+    for port, process in workers:
+        wait_for_port(port, process)
+    return workers
+
+
+def stop(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+async def run_nodes(ports, pairs, rounds):
+    '''
+    pairs: [(sender token, recipient token, connection id)]
+    '''
+    recipients = await asyncio.gather(*[
+        open_client(ports[(i + 1) % len(ports)], recipient) for i, (_, recipient, _) in enumerate(pairs)
+    ])
+    senders = await asyncio.gather(*[
+        open_client(ports[i % len(ports)], sender) for i, (sender, _, _) in enumerate(pairs)
+    ])
+    latencies = []
+
+    async def send(client, connection_id):
+        for _ in range(rounds):
+            client.send_json({
+                'source': 'message.send',
+                'connectionId': connection_id,
+                'message': repr(time.perf_counter()),
+            })
+            await client.receive_source('message.send')
+
+    async def receive(client):
+        for _ in range(rounds):
+            frame = await client.receive_source('message.send')
+            latencies.append(time.perf_counter() - float(frame['data']['message']['text']))
+
+    started = time.perf_counter()
+    await asyncio.gather(
+        *[send(client, connection_id) for client, (_, _, connection_id) in zip(senders, pairs)],
+        *[receive(client) for client in recipients],
+    )
+    elapsed = time.perf_counter() - started
+
+    for client in senders + recipients:
+        await client.close()
+    return {
+        'workers': len(ports),
+        'messages': len(latencies),
+        'messages_per_second': len(latencies) / elapsed,
+        'latency': harness.percentiles(latencies),
+    }
+
+
+def main():
+    parser = harness.parser(__doc__)
+    parser.add_argument('--nodes', default='1,2,4', help='comma-separated worker counts to run')
+    parser.add_argument('--redis', type=int, default=3, help='channel layer shards')
+    parser.add_argument('--pairs', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--redis-port', type=int, default=7400)
+    parser.add_argument('--port', type=int, default=8400)
+    args = parser.parse_args()
+    node_counts = [int(count) for count in args.nodes.split(',')]
+
+    directory = tempfile.mkdtemp(prefix='bench-cluster-')
+    redis_ports = [args.redis_port + i for i in range(args.redis)]
+    servers = [start_redis(port, directory) for port in redis_ports]
+    env = {
+        'DJANGO_SETTINGS_MODULE': 'core.settings',
+        'CHAT_LAYER_HOSTS': ','.join(f'redis://127.0.0.1:{port}' for port in redis_ports),
+        'CHAT_REDIS_URL': f'redis://127.0.0.1:{redis_ports[0]}',
+        'CHAT_DB_PROFILE': 'sqlite-wal',
+        'CHAT_SQLITE_PATH': os.path.join(directory, 'db.sqlite3'),
+        'CHAT_WRITE_BEHIND': '1',
+        'CHAT_WRITE_BEHIND_DIR': os.path.join(directory, 'journal'),
+    }
+    # Settings are read from the environment, here and in every worker
+    os.environ.update(env)
+    log = open(os.path.join(directory, 'workers.log'), 'w')
+    try:
+        django.setup()
+        from django.core.management import call_command
+        from rest_framework_simplejwt.tokens import AccessToken
+
+        from chat.models import Connection
+
+        call_command('migrate', verbosity=0)
+        senders = harness.make_users(args.pairs, 'sender')
+        recipients = harness.make_users(args.pairs, 'recipient')
+        Connection.objects.bulk_create([
+            Connection(sender=sender, receiver=recipient, accepted=True)
+            for sender, recipient in zip(senders, recipients)
+        ])
+        connection_ids = Connection.objects.order_by('sender_id').values_list('id', flat=True)
+        pairs = [
+            (str(AccessToken.for_user(sender)), str(AccessToken.for_user(recipient)), connection_id)
+            for sender, recipient, connection_id in zip(senders, recipients, connection_ids)
+        ]
+
+        results = {}
+        for count in node_counts:
+            for port in redis_ports:
+                redis.Redis(port=port).flushall()
+            workers = start_workers(count, args.port, env, log)
+            try:
+                results[f'workers_{count}'] = asyncio.run(
+                    run_nodes([port for port, _ in workers], pairs, args.rounds)
+                )
+            finally:
+                stop([process for _, process in workers])
+    finally:
+        stop(servers)
+        log.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    harness.report('cluster', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
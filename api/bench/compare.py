@@ -0,0 +1,86 @@
+'''
+Compare two saved benchmark reports (the --output of any bench module).
+
+    python -m bench.compare before.json after.json --threshold 10
+
+Prints every numeric result in both, with its relative change. A result
+counts as a regression when it moved the wrong way by more than
+--threshold percent. Wrong means up for times (_ms, seconds), query
+counts and bytes, and down for rates (_per_second). Exits with status 1
+if there is any regression.
+'''
+import argparse
+import json
+import sys
+
+HIGHER_IS_WORSE = ('_ms', 'seconds', 'queries_per_frame', 'queries', '_bytes', 'bytes_per_connection')
+LOWER_IS_WORSE = ('_per_second',)
+
+
+def flatten(results, prefix=''):
+    '''
+    {'a': {'b': 1}} -> {'a.b': 1}, numbers only.
+    '''
+    flat = {}
+    for key, value in results.items():
+        path = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{path}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def direction(path):
+    '''
+    1 if a rise is a regression, -1 if a fall is, 0 if neither.
+    '''
+    name = path.rsplit('.', 1)[-1]
+    if name.endswith(LOWER_IS_WORSE):
+        return -1
+    if name.endswith(HIGHER_IS_WORSE):
+        return 1
+    return 0
+
+
+def compare(before, after, threshold):
+    '''
+    [(path, before, after, change %, regressed)] for results in both.
+    '''
+    old, new = flatten(before['results']), flatten(after['results'])
+    rows = []
+    for path in sorted(old.keys() & new.keys()):
+        if old[path] == 0:
+            change = 0.0 if new[path] == 0 else float('inf')
+        else:
+            change = (new[path] - old[path]) / abs(old[path]) * 100
+        rows.append((path, old[path], new[path], change, change * direction(path) > threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=10.0, help='percent change tolerated (default 10)')
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    if before.get('benchmark') != after.get('benchmark'):
+        sys.exit(f"different benchmarks: {before.get('benchmark')} vs {after.get('benchmark')}")
+
+    rows = compare(before, after, args.threshold)
+    width = max((len(path) for path, *_ in rows), default=0)
+    for path, old, new, change, regressed in rows:
+        marker = '  REGRESSION' if regressed else ''
+        print(f'{path:<{width}}  {old:>14.3f}  {new:>14.3f}  {change:>+8.1f}%{marker}')
+    regressions = sum(regressed for *_, regressed in rows)
+    print(f'{regressions} regression(s) over {args.threshold:g}%')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
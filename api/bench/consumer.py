@@ -0,0 +1,99 @@
+'''
+Compare the async ChatConsumer against the original sync consumer.
+
+For each consumer: open N concurrent sockets (connect rate, Python heap per
+connection), then have every client fire R message.send frames at once and
+time each receive -> send round trip.
+'''
+import asyncio
+import gc
+import time
+import tracemalloc
+
+from bench import harness
+
+
+async def run_consumer(consumer, users, connection_ids, rounds):
+    # Connect everyone at once
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    clients = await asyncio.gather(*[
+        harness.open_client(consumer, user) for user in users
+    ])
+    connect_time = time.perf_counter() - started
+    heap_per_connection = (tracemalloc.get_traced_memory()[0] - before) / len(clients)
+    tracemalloc.stop()
+
+    latencies = []
+
+    async def drive(client, connection_id):
+        for i in range(rounds):
+            sent = time.perf_counter()
+            await client.send_json_to({
+                'source': 'message.send',
+                'connectionId': connection_id,
+                'message': f'ping {i}',
+            })
+            await harness.receive_source(client, 'message.send')
+            latencies.append(time.perf_counter() - sent)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        drive(client, connection_id)
+        for client, connection_id in zip(clients, connection_ids)
+    ])
+    elapsed = time.perf_counter() - started
+
+    for client in clients:
+        await client.disconnect()
+
+    return {
+        'connections': len(clients),
+        'connect_seconds': connect_time,
+        'connections_per_second': len(clients) / connect_time,
+        'heap_bytes_per_connection': heap_per_connection,
+        'messages': len(latencies),
+        'messages_per_second': len(latencies) / elapsed,
+        'latency': harness.percentiles(latencies),
+    }
+
+
+def main():
+    parser = harness.parser(__doc__)
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    teardown = harness.setup(redis_features=args.redis_features)
+    try:
+        from bench.legacy import SyncChatConsumer
+        from chat.consumers import ChatConsumer
+        from chat.models import Connection
+
+        # Each client talks to its own partner who stays offline, so every
+        # receive -> send measures exactly one handler invocation
+        users = harness.make_users(args.clients, 'client')
+        partners = harness.make_users(args.clients, 'partner')
+        Connection.objects.bulk_create([
+            Connection(sender=user, receiver=partner, accepted=True)
+            for user, partner in zip(users, partners)
+        ])
+        connection_ids = list(
+            Connection.objects.order_by('sender_id').values_list('id', flat=True)
+        )
+
+        results = {}
+        for name, consumer in (('sync', SyncChatConsumer), ('async', ChatConsumer)):
+            results[name] = asyncio.run(
+                run_consumer(consumer, users, connection_ids, args.rounds)
+            )
+    finally:
+        teardown()
+
+    harness.report('consumer', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
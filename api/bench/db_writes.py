@@ -0,0 +1,114 @@
+'''
+message.send write throughput across database profiles (CHAT_DB_PROFILE).
+
+Each profile runs in its own process. Writer threads, like db_batch's
+threads, each insert messages through the message.send batch
+(ChatConsumer.create_message), so each write also updates the
+connection's inbox columns. Reports messages/s, latency and failed writes,
+such as SQLite's 'database is locked'.
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench import harness
+
+
+def write(create_message, user, connection_id, count, barrier):
+    from django.db import OperationalError, connection
+
+    latencies = []
+    errors = 0
+    barrier.wait()
+    try:
+        for i in range(count):
+            sent = time.perf_counter()
+            try:
+                create_message(None, user, connection_id, f'message {i}')
+            except OperationalError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - sent)
+    finally:
+        connection.close()
+    return latencies, errors
+
+
+def run_profile(args):
+    teardown = harness.setup(sqlite_file=True, redis_features=args.redis_features)
+    try:
+        from django.db import connection
+        from chat.consumers import ChatConsumer
+        from chat.models import Connection, Message
+
+        users = harness.make_users(args.writers * 2, 'writer')
+        pairs = [
+            Connection.objects.create(sender=users[i], receiver=users[i + 1], accepted=True)
+            for i in range(0, len(users), 2)
+        ]
+        vendor = connection.vendor
+        # Threads open their own connections; the test database must be on disk
+        connection.close()
+
+        create_message = ChatConsumer.create_message.__wrapped__
+        barrier = threading.Barrier(args.writers)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.writers) as pool:
+            results = list(pool.map(
+                lambda pair: write(create_message, pair.sender, pair.id, args.messages, barrier),
+                pairs
+            ))
+        elapsed = time.perf_counter() - started
+
+        latencies = [latency for result, _ in results for latency in result]
+        written = Message.objects.count()
+    finally:
+        teardown()
+
+    return {
+        'vendor': vendor,
+        'messages': written,
+        'errors': sum(errors for _, errors in results),
+        'messages_per_second': written / elapsed,
+        'latency': harness.percentiles(latencies),
+    }
+
+
+def main():
+    parser = harness.parser(__doc__)
+    parser.add_argument('--profiles', default='sqlite,sqlite-wal',
+                        help='comma separated; add postgres when POSTGRES_* is set')
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--messages', type=int, default=200, help='per writer')
+    parser.add_argument('--run-profile', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_profile:
+        # Child process: settings were read with this profile's environment
+        sys.stdout.write(json.dumps(run_profile(args)) + '\n')
+        return
+
+    results = {}
+    for profile in args.profiles.split(','):
+        completed = subprocess.run(
+            [sys.executable, '-m', 'bench.db_writes', '--run-profile', profile,
+             '--writers', str(args.writers), '--messages', str(args.messages)]
+            + (['--redis-features'] if args.redis_features else []),
+            env={**os.environ, 'CHAT_DB_PROFILE': profile},
+            capture_output=True, text=True
+        )
+        if completed.returncode:
+            results[profile] = {'failed': completed.stderr.strip().splitlines()[-1:]}
+        else:
+            results[profile] = json.loads(completed.stdout.strip().splitlines()[-1])
+
+    harness.report('db_writes', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+'''
+friends.list cost for a user with many connections.
+
+Compares the original query (two correlated subqueries per row, friends
+loaded lazily) with the denormalized inbox columns on Connection.
+'''
+import time
+
+from bench import harness
+
+
+def measure(func, user, repeat):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    timings = []
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            rows = func(user)
+            timings.append(time.perf_counter() - started)
+    return {
+        'rows': len(rows),
+        'queries': len(queries),
+        'latency': harness.percentiles(timings),
+    }
+
+
+def main():
+    parser = harness.parser(__doc__)
+    parser.add_argument('--connections', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=3, help='messages per connection')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    teardown = harness.setup(redis_features=args.redis_features)
+    try:
+        from bench.legacy import friends_list
+        from chat.consumers import ChatConsumer
+        from chat.models import Connection, Message
+
+        owner, = harness.make_users(1, 'owner')
+        friends = harness.make_users(args.connections, 'friend')
+        Connection.objects.bulk_create([
+            Connection(sender=owner if i % 2 else friend, receiver=friend if i % 2 else owner, accepted=True)
+            for i, friend in enumerate(friends)
+        ], batch_size=1000)
+        # Message.save keeps the inbox columns current; bulk_create skips it
+        for connection in Connection.objects.all():
+            for i in range(args.messages):
+                Message.objects.create(connection=connection, user=owner, text=f'message {i}')
+
+        get_friends_list = ChatConsumer.get_friends_list.__wrapped__
+        results = {
+            'original': measure(friends_list, owner, args.repeat),
+            'denormalized': measure(lambda user: get_friends_list(ChatConsumer(), user), owner, args.repeat),
+        }
+    finally:
+        teardown()
+
+    harness.report('friends_list', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
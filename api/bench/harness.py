@@ -0,0 +1,145 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import django
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'CONFIG': {
+            'capacity': 100000,
+        },
+    },
+}
+
+LOCAL_PROFILE_CACHE = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'bench-profiles',
+}
+
+
+def setup(channel_layers=None, sqlite_file=False, redis_features=False):
+    '''
+    Configure Django against a throwaway test database and media root.
+
+    SQLite test databases live in memory unless sqlite_file is set, which
+    a benchmark of file locking and journaling needs. The Redis-backed
+    features (inbox, presence, offline queue, shared profile cache) are off
+    unless redis_features is set: they key by user id, and the test
+    database's ids are real users' ids too. Returns a teardown callable.
+    '''
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+    django.setup()
+
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import override_settings, setup_test_environment
+
+    if not redis_features:
+        from chat import inbox, offline, presence
+
+        inbox.INBOX_REDIS_URL = None
+        presence.PRESENCE_REDIS_URLS = []
+        offline.OFFLINE_REDIS_URL = None
+        override_settings(CACHES={**settings.CACHES, 'profiles': LOCAL_PROFILE_CACHE}).enable()
+
+    if sqlite_file and connection.vendor == 'sqlite':
+        path = os.path.join(tempfile.mkdtemp(prefix='bench-db-'), 'test.sqlite3')
+        connection.settings_dict['TEST']['NAME'] = path
+
+    settings.CHANNEL_LAYERS = channel_layers or IN_MEMORY_CHANNEL_LAYERS
+    settings.MEDIA_ROOT = tempfile.mkdtemp(prefix='bench-media-')
+    # Hashing thousands of passwords would dominate fixture setup
+    settings.PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, keepdb=False)
+
+    def teardown():
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    return teardown
+
+
+def make_users(count, prefix='user'):
+    from chat import search
+    from chat.models import User
+
+    User.objects.bulk_create([
+        User(username=f'{prefix}{i}', first_name=prefix, last_name=str(i))
+        for i in range(count)
+    ], batch_size=1000)
+    # bulk_create skips the post_save hook that feeds the search index
+    search.rebuild_index()
+    return list(User.objects.filter(username__startswith=prefix).order_by('id'))
+
+
+async def open_client(consumer, user, path='/chat/'):
+    from channels.testing import WebsocketCommunicator
+
+    communicator = WebsocketCommunicator(consumer.as_asgi(), path)
+    communicator.scope['user'] = user
+    connected, _ = await communicator.connect(timeout=30)
+    if not connected:
+        raise RuntimeError(f'{user.username} could not connect')
+    return communicator
+
+
+async def receive_source(communicator, source, timeout=30):
+    # Skip unrelated pushes until the expected reply arrives
+    while True:
+        response = await communicator.receive_json_from(timeout=timeout)
+        if response.get('source') == source:
+            return response
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(p):
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    return {
+        'count': len(ordered),
+        'mean_ms': statistics.fmean(ordered) * 1000,
+        'p50_ms': pick(50) * 1000,
+        'p90_ms': pick(90) * 1000,
+        'p99_ms': pick(99) * 1000,
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+def parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--output', help='write the JSON report to this path')
+    parser.add_argument(
+        '--redis-features', action='store_true',
+        help='keep the inbox, presence, offline queue and profile cache on the configured Redis'
+    )
+    return parser
+
+
+def report(name, params, results, output=None):
+    data = {
+        'benchmark': name,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'params': params,
+        'results': results,
+    }
+    text = json.dumps(data, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+    return data
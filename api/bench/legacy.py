@@ -0,0 +1,100 @@
+'''
+Frozen copy of the original sync ChatConsumer, kept as a baseline for the
+consumer benchmarks. print() calls are stripped so they don't skew timings.
+'''
+import json
+
+from asgiref.sync import async_to_sync
+from channels.generic.websocket import WebsocketConsumer
+from django.db.models import Q, OuterRef
+from django.db.models.functions import Coalesce
+
+from chat.models import Connection, Message
+from chat.serializers import UserSerializer, RequestSerializer, FriendSerializer, MessageSerializer
+
+
+def friends_list(user):
+    # Correlated subqueries per row, friends loaded lazily by the serializer
+    latest_message = Message.objects.filter(connection=OuterRef('id')).order_by('-created')[:1]
+    connections = Connection.objects.filter(
+        Q(sender=user, accepted=True) | Q(receiver=user, accepted=True)
+    ).annotate(
+        latest_text=latest_message.values('text'),
+        latest_created=latest_message.values('created')
+    ).order_by(
+        Coalesce('latest_created', 'updated')
+    )
+    return FriendSerializer(connections, context={'user': user}, many=True).data
+
+
+class SyncChatConsumer(WebsocketConsumer):
+
+    def connect(self):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+        self.username = user.username
+        async_to_sync(self.channel_layer.group_add)(
+            self.username, self.channel_name
+        )
+        self.accept()
+
+    def disconnect(self, close_code):
+        async_to_sync(self.channel_layer.group_discard)(
+            self.username, self.channel_name
+        )
+
+    def receive(self, text_data=None):
+        data = json.loads(text_data)
+        data_source = data.get('source')
+        if data_source == 'request.list':
+            self.receive_request_list(data)
+        if data_source == 'friends.list':
+            self.receive_friends_list(data)
+        if data_source == 'message.send':
+            self.receive_message_send(data)
+
+    def receive_message_send(self, data):
+        user = self.scope['user']
+        try:
+            connection = Connection.objects.get(pk=data.get('connectionId'))
+        except Connection.DoesNotExist:
+            return
+        message = Message.objects.create(
+            connection=connection,
+            user=user,
+            text=data.get('message')
+        )
+        recipient = connection.sender
+        if connection.sender == user:
+            recipient = connection.receiver
+
+        self.send_group(user.username, 'message.send', {
+            'message': MessageSerializer(message, context={'user': user}).data,
+            'friend': UserSerializer(recipient).data
+        })
+        self.send_group(recipient.username, 'message.send', {
+            'message': MessageSerializer(message, context={'user': recipient}).data,
+            'friend': UserSerializer(user).data
+        })
+
+    def receive_friends_list(self, data):
+        user = self.scope['user']
+        self.send_group(user.username, 'friends.list', friends_list(user))
+
+    def receive_request_list(self, data):
+        user = self.scope['user']
+        connections = Connection.objects.filter(receiver=user, accepted=False)
+        serialized = RequestSerializer(connections, many=True)
+        self.send_group(user.username, 'request.list', serialized.data)
+
+    def send_group(self, group, source, data):
+        async_to_sync(self.channel_layer.group_send)(group, {
+            'type': 'broadcast_group',
+            'source': source,
+            'data': data
+        })
+
+    def broadcast_group(self, data):
+        data.pop('type')
+        self.send(text_data=json.dumps(data))
@@ -0,0 +1,214 @@
+'''
+End-to-end protocol load through the real ASGI stack.
+
+core.asgi.application runs in process, with origin checks and JWT
+query-string auth. Client pairs (A, B), each user holding an access
+token, go through these phases together:
+
+    connect           everyone opens a socket
+    search            A searches for B
+    request.connect   A asks B; both get the request
+    request.accept    B accepts; both get the connection
+    message.send      A sends R messages, each waiting for B's copy
+    message.list      A loads the conversation, R times
+    friends.list      B loads its inbox, R times
+
+For every phase the report gives:
+
+- frames per second
+- client-side latency percentiles
+- DB queries per handled frame (from chat.metrics)
+
+The connect phase reports Python heap per open socket instead.
+
+By default the channel layer is in memory, and the Redis-backed features
+(inbox, presence, offline queue) are off. --redis uses the configured
+Redis layer (CHAT_LAYER_HOSTS) and leaves those features on.
+
+Save runs with --output and diff them with bench.compare.
+'''
+import asyncio
+import gc
+import os
+import time
+import tracemalloc
+
+from bench import harness
+
+ORIGIN = (b'origin', b'http://127.0.0.1')
+
+
+async def open_client(application, token):
+    from channels.testing import WebsocketCommunicator
+
+    communicator = WebsocketCommunicator(application, f'/chat/?token={token}', headers=[ORIGIN])
+    connected, _ = await communicator.connect(timeout=30)
+    if not connected:
+        raise RuntimeError('socket refused')
+    return communicator
+
+
+def query_totals():
+    from chat import metrics
+
+    # {source: (queries, frames)} so far
+    return {key[0]: (state[1], state[2]) for key, state in metrics.FRAME_QUERIES.values.items()}
+
+
+async def phase(name, steps, frames):
+    '''
+    Run one coroutine per client at once; steps return their latencies.
+    '''
+    before = query_totals()
+    started = time.perf_counter()
+    latencies = [latency for latencies in await asyncio.gather(*steps) for latency in latencies]
+    elapsed = time.perf_counter() - started
+    queries, handled = (
+        total - before.get(name, (0, 0))[index]
+        for index, total in enumerate(query_totals().get(name, (0, 0)))
+    )
+    return {
+        'frames': frames,
+        'seconds': elapsed,
+        'frames_per_second': frames / elapsed,
+        'queries_per_frame': queries / handled if handled else None,
+        'latency': harness.percentiles(latencies),
+    }
+
+
+async def request(client, frame, source=None):
+    sent = time.perf_counter()
+    await client.send_json_to(frame)
+    response = await harness.receive_source(client, source or frame['source'])
+    return time.perf_counter() - sent, response
+
+
+async def run(application, pairs, rounds):
+    '''
+    pairs: [(A, A's token, B, B's token)]
+    '''
+    results = {}
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    clients = await asyncio.gather(*[
+        open_client(application, token) for _, a_token, _, b_token in pairs for token in (a_token, b_token)
+    ])
+    elapsed = time.perf_counter() - started
+    heap = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    results['connect'] = {
+        'connections': len(clients),
+        'connections_per_second': len(clients) / elapsed,
+        'heap_bytes_per_connection': heap / len(clients),
+    }
+    sides = list(zip(clients[0::2], clients[1::2]))
+
+    async def search(a_client, b):
+        latency, _ = await request(a_client, {'source': 'search', 'query': b.username})
+        return [latency]
+
+    results['search'] = await phase('search', [
+        search(a_client, b) for (a_client, _), (_, _, b, _) in zip(sides, pairs)
+    ], len(pairs))
+
+    async def connect(a_client, b_client, b):
+        latency, _ = await request(a_client, {'source': 'request.connect', 'username': b.username})
+        await harness.receive_source(b_client, 'request.connect')
+        return [latency]
+
+    results['request.connect'] = await phase('request.connect', [
+        connect(a_client, b_client, b) for (a_client, b_client), (_, _, b, _) in zip(sides, pairs)
+    ], len(pairs))
+
+    async def accept(a_client, b_client, a):
+        latency, _ = await request(b_client, {'source': 'request.accept', 'username': a.username})
+        await harness.receive_source(a_client, 'request.accept')
+        return [latency]
+
+    results['request.accept'] = await phase('request.accept', [
+        accept(a_client, b_client, a) for (a_client, b_client), (a, _, _, _) in zip(sides, pairs)
+    ], len(pairs))
+    connection_by_pair = await connection_map(pairs, sides)
+
+    async def send(a_client, b_client):
+        latencies = []
+        for i in range(rounds):
+            sent = time.perf_counter()
+            await a_client.send_json_to({
+                'source': 'message.send',
+                'connectionId': connection_by_pair[id(a_client)],
+                'message': f'message {i}',
+            })
+            await harness.receive_source(b_client, 'message.send')
+            latencies.append(time.perf_counter() - sent)
+            await harness.receive_source(a_client, 'message.send')
+        return latencies
+
+    results['message.send'] = await phase('message.send', [
+        send(a_client, b_client) for a_client, b_client in sides
+    ], len(pairs) * rounds)
+
+    async def repeat(client, frame):
+        return [(await request(client, frame))[0] for _ in range(rounds)]
+
+    results['message.list'] = await phase('message.list', [
+        repeat(a_client, {'source': 'message.list', 'connectionId': connection_by_pair[id(a_client)]})
+        for a_client, _ in sides
+    ], len(pairs) * rounds)
+
+    results['friends.list'] = await phase('friends.list', [
+        repeat(b_client, {'source': 'friends.list'}) for _, b_client in sides
+    ], len(pairs) * rounds)
+
+    for client in clients:
+        await client.disconnect()
+    return results
+
+
+async def connection_map(pairs, sides):
+    from chat.models import Connection
+
+    ids = {
+        (sender_id, receiver_id): connection_id
+        async for connection_id, sender_id, receiver_id in Connection.objects.values_list('id', 'sender_id', 'receiver_id')
+    }
+    return {id(a_client): ids[(a.pk, b.pk)] for (a_client, _), (a, _, b, _) in zip(sides, pairs)}
+
+
+def main():
+    parser = harness.parser(__doc__)
+    parser.add_argument('--pairs', type=int, default=500, help='client pairs; twice as many sockets')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--redis', action='store_true', help='use the configured Redis channel layer and features')
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+    from django.conf import settings
+
+    teardown = harness.setup(
+        channel_layers=settings.CHANNEL_LAYERS if args.redis else None,
+        redis_features=args.redis or args.redis_features,
+    )
+    try:
+        from rest_framework_simplejwt.tokens import AccessToken
+
+        from core.asgi import application
+
+        senders = harness.make_users(args.pairs, 'loadsender')
+        receivers = harness.make_users(args.pairs, 'loadreceiver')
+        pairs = [
+            (a, str(AccessToken.for_user(a)), b, str(AccessToken.for_user(b)))
+            for a, b in zip(senders, receivers)
+        ]
+        results = asyncio.run(run(application, pairs, args.rounds))
+    finally:
+        teardown()
+
+    harness.report('load', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
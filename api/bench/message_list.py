@@ -0,0 +1,61 @@
+'''
+message.list latency and payload size against growing chat history.
+
+With keyset pagination both should stay flat as the history grows.
+'''
+import asyncio
+import time
+
+from bench import harness
+
+
+async def measure(consumer, user, connection_id, requests):
+    client = await harness.open_client(consumer, user)
+    latencies = []
+    payload = 0
+    for _ in range(requests):
+        sent = time.perf_counter()
+        await client.send_json_to({
+            'source': 'message.list',
+            'connectionId': connection_id,
+        })
+        output = await client.receive_output(timeout=30)
+        latencies.append(time.perf_counter() - sent)
+        payload = len(output['text'])
+    await client.disconnect()
+    return {
+        'payload_bytes': payload,
+        'latency': harness.percentiles(latencies),
+    }
+
+
+def main():
+    parser = harness.parser(__doc__)
+    parser.add_argument('--sizes', default='100,1000,10000,50000')
+    parser.add_argument('--requests', type=int, default=50)
+    args = parser.parse_args()
+
+    teardown = harness.setup(redis_features=args.redis_features)
+    try:
+        from chat.consumers import ChatConsumer
+        from chat.models import Connection, Message
+
+        alice, bob = harness.make_users(2, 'history')
+        results = {}
+        for size in [int(size) for size in args.sizes.split(',')]:
+            connection = Connection.objects.create(sender=alice, receiver=bob, accepted=True)
+            Message.objects.bulk_create([
+                Message(connection=connection, user=alice if i % 2 else bob, text=f'message {i}')
+                for i in range(size)
+            ], batch_size=1000)
+            results[size] = asyncio.run(
+                measure(ChatConsumer, alice, connection.id, args.requests)
+            )
+    finally:
+        teardown()
+
+    harness.report('message_list', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''
+Per-frame parse, dispatch and encode overhead in ChatConsumer.receive.
+
+Compares the original json.loads + pretty-print + if-chain against the
+router with each available codec. No database or channel layer involved.
+'''
+import io
+import json
+import time
+from contextlib import redirect_stdout
+
+from bench import harness
+
+FRAMES = [
+    {'source': 'message.send', 'connectionId': 42, 'message': 'hello there ' * 5},
+    {'source': 'message.list', 'connectionId': 42, 'cursor': 'MjAyNS0wMS0wMVQwMDowMDowMHwxMjM'},
+    {'source': 'friends.list'},
+    {'source': 'search', 'query': 'alice'},
+    {'source': 'request.accept', 'username': 'bob'},
+]
+REPLY = {
+    'source': 'message.send',
+    'data': {
+        'message': {'id': 1, 'is_me': True, 'text': 'hello there ' * 5, 'created': '2025-01-01T00:00:00Z'},
+        'friend': {'username': 'bob', 'name': 'Bob Jones', 'thumbnail': '/media/avatars/ab/abcdef/small.jpg'},
+    },
+}
+LEGACY_SOURCES = [
+    'thumbnail', 'thumbnail.upload', 'search', 'request.connect', 'request.list',
+    'request.accept', 'request.decline', 'message.list', 'friends.list', 'message.send',
+]
+
+
+def legacy(text):
+    # What receive did per frame before the router
+    data = json.loads(text)
+    data_source = data.get('source')
+    print('receive', json.dumps(data, indent=2))
+    for source in LEGACY_SOURCES:
+        if data_source == source:
+            break
+    return json.dumps(REPLY)
+
+
+def routed(codec, router):
+    def handle(text):
+        router.resolve(codec.loads(text))
+        return codec.dumps(REPLY)
+    return handle
+
+
+def measure(handle, texts, rounds):
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        for _ in range(rounds):
+            for text in texts:
+                handle(text)
+    elapsed = time.perf_counter() - start
+    frames = rounds * len(texts)
+    return {
+        'frames_per_second': frames / elapsed,
+        'us_per_frame': elapsed / frames * 1e6,
+    }
+
+
+def main():
+    parser = harness.parser(__doc__)
+    parser.add_argument('--rounds', type=int, default=20000)
+    args = parser.parse_args()
+
+    teardown = harness.setup(redis_features=args.redis_features)
+    try:
+        from chat import protocol
+        from chat.consumers import router
+
+        texts = [json.dumps(frame) for frame in FRAMES]
+        results = {'legacy': measure(legacy, texts, args.rounds)}
+        for name in protocol.CODECS:
+            try:
+                codec = protocol.get_codec(name)
+            except protocol.ImproperlyConfigured:
+                continue
+            results[name] = measure(routed(codec, router), texts, args.rounds)
+    finally:
+        teardown()
+
+    harness.report('protocol', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+'''
+Avatar thumbnail pipeline: throughput and memory per source image size.
+
+Compares the original pipeline (full decode, quality=100) with
+chat.images.make_thumbnail (JPEG draft mode, quality 85). Memory is the
+peak RSS growth while resizing one image in a worker process, so it
+includes Pillow's native buffers (Linux only).
+'''
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from bench import harness
+
+SIZES = {
+    'vga': (640, 480),
+    '1080p': (1920, 1080),
+    '12mp': (4032, 3024),
+}
+
+
+def source_image(size):
+    from PIL import Image as PILImage, ImageFilter
+
+    # Blurred noise compresses roughly like a phone photo
+    image = PILImage.effect_noise(size, 64).convert('RGB').filter(ImageFilter.GaussianBlur(3))
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def original(image_data):
+    from PIL import Image as PILImage
+
+    # The pipeline receive_thumbnail used to run inline: full decode,
+    # LANCZOS from full size, quality=100
+    image = PILImage.open(BytesIO(image_data))
+    if image.mode == 'RGBA':
+        image = image.convert('RGB')
+    image.thumbnail((400, 400), PILImage.LANCZOS)
+    output = BytesIO()
+    image.save(output, format='JPEG', quality=100)
+    return output.getvalue()
+
+
+def pipelines():
+    from chat.images import make_thumbnail
+    return {'original': original, 'current': make_thumbnail}
+
+
+def rss(field):
+    # Linux only: VmRSS is current, VmHWM the peak since the last reset
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+
+
+def peak_memory(name, image_data):
+    func = pipelines()[name]
+    # Load Pillow's codecs and plugins before measuring
+    func(source_image((16, 16)))
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    before = rss('VmRSS')
+    output = func(image_data)
+    return rss('VmHWM') - before, len(output)
+
+
+def main():
+    parser = harness.parser(__doc__)
+    parser.add_argument('--images', type=int, default=20, help='images per size and pipeline')
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    teardown = harness.setup(redis_features=args.redis_features)
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    try:
+        for label, size in SIZES.items():
+            image_data = source_image(size)
+            results[label] = {'source_bytes': len(image_data)}
+            for name, func in pipelines().items():
+                started = time.perf_counter()
+                for _ in range(args.images):
+                    func(image_data)
+                serial = args.images / (time.perf_counter() - started)
+
+                with ProcessPoolExecutor(1, mp_context=context) as pool:
+                    memory, output_bytes = pool.submit(peak_memory, name, image_data).result()
+
+                with ProcessPoolExecutor(args.workers, mp_context=context) as pool:
+                    # Warm every worker up before timing
+                    list(pool.map(func, [image_data] * args.workers))
+                    started = time.perf_counter()
+                    list(pool.map(func, [image_data] * args.images))
+                    pooled = args.images / (time.perf_counter() - started)
+
+                results[label][name] = {
+                    'images_per_second': serial,
+                    'pool_images_per_second': pooled,
+                    'peak_rss_bytes': memory,
+                    'output_bytes': output_bytes,
+                }
+    finally:
+        teardown()
+
+    harness.report('thumbnails', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+'''
+message.send throughput: INSERT-then-deliver against write-behind.
+
+Clients each fire R message.send frames, one after another, and wait for
+their own copy before sending the next. Reports delivered messages/s,
+receive -> send latency, and for write-behind how long after the last
+delivery every message was in the database. The test database is a file,
+so SQLite's write lock is in play (pick another with CHAT_DB_PROFILE).
+'''
+import asyncio
+import tempfile
+import time
+
+from bench import harness
+
+
+async def run_mode(write_behind, users, connection_ids, rounds):
+    from chat import writebehind
+    from chat.consumers import ChatConsumer
+    from chat.models import Message
+
+    writebehind.WRITE_BEHIND = write_behind
+    stored_before = await Message.objects.acount()
+    clients = await asyncio.gather(*[harness.open_client(ChatConsumer, user) for user in users])
+    latencies = []
+
+    async def drive(client, connection_id):
+        for i in range(rounds):
+            sent = time.perf_counter()
+            await client.send_json_to({
+                'source': 'message.send',
+                'connectionId': connection_id,
+                'message': f'ping {i}',
+            })
+            await harness.receive_source(client, 'message.send')
+            latencies.append(time.perf_counter() - sent)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        drive(client, connection_id)
+        for client, connection_id in zip(clients, connection_ids)
+    ])
+    delivered = time.perf_counter() - started
+
+    if write_behind:
+        task = writebehind.writer().task
+        if task is not None:
+            await task
+    stored = time.perf_counter() - started
+
+    for client in clients:
+        await client.disconnect()
+
+    return {
+        'messages': len(latencies),
+        'stored': await Message.objects.acount() - stored_before,
+        'messages_per_second': len(latencies) / delivered,
+        'latency': harness.percentiles(latencies),
+        'all_stored_seconds': stored,
+    }
+
+
+def main():
+    parser = harness.parser(__doc__)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    teardown = harness.setup(sqlite_file=True, redis_features=args.redis_features)
+    try:
+        from chat import writebehind
+        from chat.models import Connection
+
+        writebehind.JOURNAL_DIR = tempfile.mkdtemp(prefix='bench-journal-')
+        if writebehind.WORKER_ID is None:
+            writebehind.WORKER_ID = 0
+        users = harness.make_users(args.clients, 'client')
+        partners = harness.make_users(args.clients, 'partner')
+        Connection.objects.bulk_create([
+            Connection(sender=user, receiver=partner, accepted=True)
+            for user, partner in zip(users, partners)
+        ])
+        connection_ids = list(
+            Connection.objects.order_by('sender_id').values_list('id', flat=True)
+        )
+
+        results = {}
+        for name, write_behind in (('insert', False), ('write_behind', True)):
+            results[name] = asyncio.run(run_mode(write_behind, users, connection_ids, args.rounds))
+    finally:
+        teardown()
+
+    harness.report('write_behind', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,20 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        from . import archive, profiles, search
+        from .models import ArchiveSegment, User
+
+        # Keep the user search index in step with User rows
+        post_save.connect(search.index_user, sender=User, dispatch_uid='chat.search.index_user')
+        post_delete.connect(search.unindex_user, sender=User, dispatch_uid='chat.search.unindex_user')
+        # Drop cached profiles when a user changes or goes away
+        post_save.connect(profiles.invalidate, sender=User, dispatch_uid='chat.profiles.invalidate')
+        post_delete.connect(profiles.invalidate, sender=User, dispatch_uid='chat.profiles.invalidate')
+        # Archived messages go with their index row (e.g. a deleted connection)
+        post_delete.connect(archive.delete_segment_file, sender=ArchiveSegment, dispatch_uid='chat.archive.delete_segment_file')
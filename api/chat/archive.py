@@ -0,0 +1,178 @@
+'''
+Cold storage for old messages.
+
+`manage.py archive_messages` moves messages older than ARCHIVE_AFTER_DAYS
+out of chat_message into gzip JSON-lines segments under ARCHIVE_DIR, up to
+SEGMENT_SIZE messages per file:
+
+    <connection id>/<first id>-<last id>.jsonl.gz
+
+Each segment gets an ArchiveSegment row recording its (created, id) range,
+and the hot table keeps only recent history. A connection's newest message
+is never archived, since friends.list previews point at it. message.list
+keeps paging in (created, id) order: once the hot rows run out it reads
+segments, newest first, so clients can't tell where the table stops.
+
+A segment file is written (to a temporary name, then renamed) before its
+messages are deleted. Indexing it and deleting them happen in one
+transaction, so a crash leaves either both copies or only the archived
+one, never neither.
+'''
+import gzip
+import json
+import logging
+import os
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework import serializers
+
+from .models import ArchiveSegment, Message
+from .pagination import decode_cursor, encode_cursor, page_size
+
+logger = logging.getLogger(__name__)
+
+# Outside MEDIA_ROOT: archives must not be served
+ARCHIVE_DIR = getattr(settings, 'CHAT_ARCHIVE_DIR', 'archive')
+# Messages older than this many days are archived
+ARCHIVE_AFTER_DAYS = getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', 90)
+# Messages per segment file
+SEGMENT_SIZE = getattr(settings, 'CHAT_ARCHIVE_SEGMENT_SIZE', 1000)
+
+_datetime = serializers.DateTimeField()
+
+
+def segment_path(connection_id, first_id, last_id):
+    return f'{connection_id}/{first_id}-{last_id}.jsonl.gz'
+
+
+def write_segment(path, messages):
+    target = Path(ARCHIVE_DIR) / path
+    target.parent.mkdir(parents=True, exist_ok=True)
+    partial = target.with_name(target.name + '.partial')
+    with gzip.open(partial, 'wt', encoding='utf-8') as f:
+        for message in messages:
+            f.write(json.dumps({
+                'id': message.id,
+                'user': message.user_id,
+                'text': message.text,
+                'created': _datetime.to_representation(message.created),
+            }) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, target)
+
+
+def read_segment(segment):
+    '''
+    The segment's messages as unsaved Message objects, oldest first.
+    '''
+    with gzip.open(Path(ARCHIVE_DIR) / segment.path, 'rt', encoding='utf-8') as f:
+        return [
+            Message(
+                id=entry['id'],
+                connection_id=segment.connection_id,
+                user_id=entry['user'],
+                text=entry['text'],
+                created=parse_datetime(entry['created']),
+            )
+            for entry in map(json.loads, f)
+        ]
+
+
+def archivable(cutoff):
+    # The newest message of each connection stays put for friends.list
+    return Message.objects.filter(created__lt=cutoff).exclude(id=F('connection__last_message_id'))
+
+
+def archive_connection(connection_id, cutoff):
+    '''
+    Archive one connection's messages older than cutoff; returns how many.
+    '''
+    archived = 0
+    while True:
+        messages = list(
+            archivable(cutoff).filter(connection_id=connection_id).order_by('created', 'id')[:SEGMENT_SIZE]
+        )
+        if not messages:
+            return archived
+        first, last = messages[0], messages[-1]
+        path = segment_path(connection_id, first.id, last.id)
+        write_segment(path, messages)
+        with transaction.atomic():
+            ArchiveSegment.objects.create(
+                connection_id=connection_id,
+                path=path,
+                count=len(messages),
+                first_created=first.created,
+                first_id=first.id,
+                last_created=last.created,
+                last_id=last.id,
+            )
+            Message.objects.filter(id__in=[message.id for message in messages]).delete()
+        archived += len(messages)
+
+
+def archive_messages(days=None, now=None):
+    '''
+    Archive every connection's old messages; returns {connection id: count}.
+    '''
+    days = ARCHIVE_AFTER_DAYS if days is None else days
+    cutoff = (now or timezone.now()) - timedelta(days=days)
+    connection_ids = archivable(cutoff).values_list('connection_id', flat=True).distinct()
+    counts = {}
+    for connection_id in list(connection_ids):
+        counts[connection_id] = archive_connection(connection_id, cutoff)
+        logger.info('archived messages', extra={'connection_id': connection_id, 'messages': counts[connection_id]})
+    return counts
+
+
+def older_messages(connection_id, before=None, limit=None):
+    '''
+    Up to limit archived messages of a connection, newest first, older than
+    the (created, id) position before (or the newest ones).
+    '''
+    segments = ArchiveSegment.objects.filter(connection_id=connection_id)
+    if before is not None:
+        created, pk = before
+        segments = segments.filter(Q(first_created__lt=created) | Q(first_created=created, first_id__lt=pk))
+    messages = []
+    for segment in segments.order_by('-last_created', '-last_id').iterator():
+        for message in reversed(read_segment(segment)):
+            if before is None or (message.created, message.id) < before:
+                messages.append(message)
+        if limit is not None and len(messages) >= limit:
+            return messages[:limit]
+    return messages
+
+
+def extend_page(connection_id, page, cursor=None, size=None):
+    '''
+    Fill out the last hot page of message.list (next_cursor None) from the
+    archive. Returns (page, next_cursor) like paginate_messages.
+    '''
+    size = page_size(size)
+    if page:
+        before = (page[-1].created, page[-1].id)
+    elif cursor:
+        before = decode_cursor(cursor)
+    else:
+        before = None
+    page = page + older_messages(connection_id, before, size - len(page) + 1)
+    next_cursor = None
+    if len(page) > size:
+        page = page[:size]
+        next_cursor = encode_cursor(page[-1])
+    return page, next_cursor
+
+
+def delete_segment_file(sender, instance, **kwargs):
+    '''
+    post_delete receiver for ArchiveSegment, so cascades take the file too.
+    '''
+    (Path(ARCHIVE_DIR) / instance.path).unlink(missing_ok=True)
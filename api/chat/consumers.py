@@ -1,371 +1,758 @@
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer 
-import json
-import base64
-
-from django.db.models.functions import Coalesce
-
-from .serializers import UserSerializer, SearchSerializer, RequestSerializer, FriendSerializer, MessageSerializer
-from io import BytesIO
-from PIL import Image as PILImage
-import os
-from django.db.models import Q, OuterRef, Exists
+from channels.generic.websocket import AsyncWebsocketConsumer
+import asyncio
+import logging
+import time
+
+from . import archive, images, inbox, metrics, offline, presence, profiles, search, sync, writebehind
+from .db import db_batch
+from .layers import group_send_many, user_group
+from .pagination import InvalidCursor, paginate_messages
+from .protocol import ProtocolError, Router, codec, optional, required
+from .serializers import UserSerializer, FriendUserSerializer, SearchSerializer, RequestSerializer, FriendSerializer, MessageSerializer
+from .uploads import ChunkedUpload, UploadTooLarge, UPLOAD_MAX_BYTES
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
 from .models import User, Connection, Message
 
-class ChatConsumer(WebsocketConsumer):
-    
-    def connect(self):
+logger = logging.getLogger(__name__)
+
+# Frames whose handler takes longer are logged unsampled
+SLOW_FRAME_MS = getattr(settings, 'CHAT_LOG_SLOW_FRAME_MS', 250)
+# Seconds between typing events forwarded per conversation; the rest are dropped
+TYPING_INTERVAL = getattr(settings, 'CHAT_TYPING_INTERVAL', 1.0)
+
+# source -> handler and frame schema, see ChatConsumer.receive
+router = Router()
+
+
+class ChatConsumer(AsyncWebsocketConsumer):
+
+    async def connect(self):
         user = self.scope['user']
-        print(user, user.is_authenticated)
         if not user.is_authenticated:
+            logger.info('connect rejected', extra={'reason': 'unauthenticated'})
+            await self.close()
             return
         self.username = user.username
+        self.background_tasks = set()
+        self.upload = None
+        # connection id -> (friend id, friend username), for typing and
+        # write-behind message.send
+        self.peers = {}
+        # connection id -> when the friend was last sent typing
+        self.typing_sent = {}
 
         # Add user to group
-        async_to_sync(self.channel_layer.group_add)(
-            self.username, self.channel_name
+        self.group = user_group(self.username)
+        await self.channel_layer.group_add(
+            self.group, self.channel_name
         )
-        self.accept()
-
-    def disconnect(self, close_code):
+        await self.accept()
+        self.counted = True
+        if writebehind.enabled():
+            # Starts replaying messages a crashed run left in the journal
+            writebehind.writer()
+        metrics.CONNECTIONS.inc()
+        if presence.enabled():
+            await presence.safely(presence.tracker(self.channel_layer).connected(user, self.channel_name))
+        # After presence: a sender who still saw us offline has queued by now
+        if offline.enabled():
+            await self.replay_offline(user)
+        logger.info('connect', extra={'user_id': user.pk})
+
+    async def disconnect(self, close_code):
         # Remove user from group
-        async_to_sync(self.channel_layer.group_discard)(
-            self.username, self.channel_name
+        if not hasattr(self, 'username'):
+            return
+        if getattr(self, 'counted', False):
+            self.counted = False
+            metrics.CONNECTIONS.dec()
+        self.discard_upload()
+        if presence.enabled():
+            await presence.safely(presence.tracker(self.channel_layer).disconnected(self.scope['user'], self.channel_name))
+        await self.channel_layer.group_discard(
+            self.group, self.channel_name
         )
-        pass
+        logger.info('disconnect', extra={'user_id': self.scope['user'].pk, 'code': close_code})
 
     #----------------------
-    #   Handle Requests 
+    #   Handle Requests
     #----------------------
-    
-    def receive(self, text_data=None):
-        # Parse JSON data
-        data = json.loads(text_data)
-        data_source = data.get('source')
-        print('receive', json.dumps(data, indent=2))
-        
-        # Handle thumbnail
-        if data_source == 'thumbnail':
-            self.receive_thumbnail(data)
-        
-        # Handle search
-        if data_source == 'search':
-            self.receive_search(data)
-        
-        # Handle request connect
-        if data_source == 'request.connect':
-            self.receive_request_connect(data)
-        
-        # Handle request list
-        if data_source == 'request.list':
-            self.receive_request_list(data)
-        
-        # Handle request accept
-        if data_source == 'request.accept':
-            self.receive_request_accept(data)
-        
-        # Handle request decline
-        if data_source == 'request.decline':
-            self.receive_request_decline(data)
-
-        # Get message list 
-        if data_source == 'message.list':
-            self.receive_message_list(data)
-
-        # Get friends list 
-        if (data_source == 'friends.list'):
-            self.receive_friends_list(data)
-
-        if (data_source == 'message.send'):
-            self.receive_message_send(data)
-      
-    
-    def receive_message_send(self, data):
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # Binary frames carry upload chunks
+        if bytes_data is not None:
+            await self.receive_bytes(bytes_data)
+            return
+
+        try:
+            data = codec.loads(text_data)
+        except ValueError:
+            await self.send_error('Frames must be valid JSON', code='invalid_json')
+            return
+
+        # Unknown sources and malformed frames never reach a handler
+        try:
+            handler = router.resolve(data)
+        except ProtocolError as e:
+            metrics.FRAMES_REJECTED.inc(code=e.code)
+            logger.info('frame rejected', extra={'code': e.code, 'source': e.source, 'field': e.field})
+            await self.send_error(e.message, code=e.code, field=e.field, request=e.source)
+            return
+
+        source = data['source']
+        try:
+            with metrics.FrameStats(source) as stats:
+                await getattr(self, handler)(data)
+        except Exception:
+            logger.exception('frame failed', extra={'source': source, 'user_id': self.scope['user'].pk})
+            raise
+        fields = {
+            'source': source,
+            'user_id': self.scope['user'].pk,
+            'duration_ms': stats.duration_ms,
+            'queries': stats.queries,
+        }
+        if stats.duration_ms >= SLOW_FRAME_MS:
+            logger.warning('slow frame', extra=fields)
+        else:
+            # Sampled: see CHAT_LOG_FRAME_SAMPLE_RATE
+            logger.info('frame', extra={**fields, 'frame': True})
+
+    @router.route('message.send', connectionId=required(int), message=required(str))
+    async def receive_message_send(self, data):
         user = self.scope['user']
-        connectionId = data.get('connectionId')
-        message_text = data.get('message')
-        
+        if writebehind.enabled():
+            await self.queue_message(user, data.get('connectionId'), data.get('message'))
+            return
+        result = await self.create_message(
+            user, data.get('connectionId'), data.get('message')
+        )
+        if result is None:
+            return
+        recipient_username, sender_data, recipient_data, entry = result
+
+        # Deliver to sender and recipient in one channel layer round trip
+        await self.send_groups([
+            (user.username, 'message.send', sender_data),
+            (recipient_username, 'message.send', recipient_data),
+        ])
+        await self.hold_offline(inbox.other_id(entry, user.pk), recipient_data)
+        await self.update_inbox(entry)
+
+    @db_batch
+    def create_message(self, user, connectionId, message_text):
+        # Fetch the connection with both users, and only if user is part of it
         try:
-            connection = Connection.objects.get(pk=connectionId)
+            connection = Connection.objects.select_related('sender', 'receiver').get(
+                Q(sender=user) | Q(receiver=user),
+                pk=connectionId
+            )
         except Connection.DoesNotExist:
-            print(f"Connection {connectionId} does not exist")
-            return
-        
+            logger.debug('connection not found', extra={'connection_id': connectionId, 'user_id': user.pk})
+            return None
+
         # Create message
         message = Message.objects.create(
             connection=connection,
             user=user,
             text=message_text
         )
+        # Message.save updated the row; mirror it for the inbox entry
+        connection.record_message(message)
 
-        #Get recipient friend 
+        #Get recipient friend
         recipient = connection.sender
-        if (connection.sender == user):
+        if connection.sender_id == user.id:
             recipient = connection.receiver
-        
-        serialized_message = MessageSerializer(message, 
-        context={
-            'user': user
-        })
 
-        serialized_friend = UserSerializer(recipient)
+        # Serialize the message once; the recipient's copy only flips is_me
+        serialized_message = MessageSerializer(message, context={'user': user}).data
 
-        data = {
-            'message': serialized_message.data,
-            'friend': serialized_friend.data
+        sender_data = {
+            'message': serialized_message,
+            'friend': FriendUserSerializer(recipient).data
         }
-        
-        # Send message back to sender 
-        self.send_group(user.username, 'message.send', data)
+        recipient_data = {
+            'message': {**serialized_message, 'is_me': False},
+            'friend': FriendUserSerializer(user).data
+        }
+        return recipient.username, sender_data, recipient_data, inbox.connection_entry(connection)
 
-        serialized_message = MessageSerializer(message,
-        context={
-            'user': recipient
-        })
+    async def queue_message(self, user, connection_id, text):
+        '''
+        Write-behind message.send: journal, deliver, and leave the INSERT to
+        the flusher (see chat.writebehind). No queries once the socket
+        knows the connection and both profiles are cached.
+        '''
+        peer = await self.get_peer(user, connection_id)
+        if peer is None:
+            logger.debug('connection not found', extra={'connection_id': connection_id, 'user_id': user.pk})
+            return
+        recipient_id, recipient_username = peer
+
+        found, missing = profiles.local_profiles([user.pk, recipient_id], FriendUserSerializer)
+        if missing:
+            found.update(await self.get_profiles(missing))
 
-        serialized_friend = UserSerializer(user)
+        message, record = writebehind.new_message(connection_id, user.pk, text)
+        await writebehind.writer().write(record)
 
-        data = {
-            'message': serialized_message.data,
-            'friend': serialized_friend.data
+        serialized_message = MessageSerializer(message, context={'user': user}).data
+        recipient_data = {
+            'message': {**serialized_message, 'is_me': False},
+            'friend': found[user.pk]
         }
-        
-        # Send message to recipient
-        self.send_group(recipient.username, 'message.send', data)
-        
-    def receive_message_list(self, data): 
-        connectionId = data.get('connectionId')
-        page = data.get('page')
+        await self.send_groups([
+            (user.username, 'message.send', {'message': serialized_message, 'friend': found[recipient_id]}),
+            (recipient_username, 'message.send', recipient_data),
+        ])
+        await self.hold_offline(recipient_id, recipient_data)
+
+    async def hold_offline(self, recipient_id, recipient_data):
+        # The channel layer drops frames for users with no socket
+        if offline.enabled():
+            await offline.safely(offline.hold(recipient_id, recipient_data))
+
+    async def replay_offline(self, user):
+        batch = await offline.safely(offline.pending(user.pk))
+        if batch is not None:
+            # Only this socket: the ack comes back from it
+            await self.send(text_data=codec.dumps({'source': 'offline', 'data': batch}))
+
+    @router.route('offline.ack', ack=required(str))
+    async def receive_offline_ack(self, data):
+        if not offline.enabled():
+            return
         user = self.scope['user']
+        try:
+            await offline.safely(offline.ack(user.pk, data.get('ack')))
+        except offline.InvalidAck:
+            await self.send_error('Invalid offline.ack id', code='invalid_field', field='ack', request='offline.ack')
+            return
+        await self.replay_offline(user)
 
-        #Get connection 
-        try: 
-            connection = Connection.objects.get(pk=connectionId)
-        except Connection.DoesNotExist:
-            print(f"Connection {connectionId} does not exist")
+    @router.route('message.list', connectionId=required(int), cursor=optional(str), page=optional(int, str), pageSize=optional(int))
+    async def receive_message_list(self, data):
+        user = self.scope['user']
+        # Older clients send a numeric page; only string cursors are honoured
+        cursor = data.get('cursor') or data.get('page')
+        if not isinstance(cursor, str):
+            cursor = None
+        try:
+            data = await self.get_message_list(
+                user, data.get('connectionId'), cursor, data.get('pageSize')
+            )
+        except InvalidCursor:
+            await self.send_error('Invalid message.list cursor', code='invalid_field', field='cursor', request='message.list')
+            return
+        if data is None:
             return
+        await self.send_group(user.username, 'message.list', data)
 
-        messages = Message.objects.filter(connection=connection).order_by('-created')
+    @db_batch
+    def get_message_list(self, user, connectionId, cursor, size):
+        # Get connection, only if user is part of it
+        try:
+            connection = Connection.objects.select_related('sender', 'receiver').get(
+                Q(sender=user) | Q(receiver=user),
+                pk=connectionId
+            )
+        except Connection.DoesNotExist:
+            logger.debug('connection not found', extra={'connection_id': connectionId, 'user_id': user.pk})
+            return None
+
+        messages, next_cursor = paginate_messages(
+            Message.objects.filter(connection=connection), cursor, size
+        )
+        if next_cursor is None:
+            # Out of hot rows: carry on into archived history
+            messages, next_cursor = archive.extend_page(connection.pk, messages, cursor, size)
 
-        serialized_message = MessageSerializer(messages, 
+        serialized_message = MessageSerializer(messages,
         context = {
             'user': user
         },
         many=True)
 
         #Get recipient
-        recipient = connection.sender 
+        recipient = connection.sender
         if connection.sender == user:
             recipient = connection.receiver
-        
-        # Serialize friend 
-        serialized_friend = UserSerializer(recipient)
 
-        data = {
+        # Serialize friend
+        serialized_friend = FriendUserSerializer(recipient)
+
+        return {
             'messages': serialized_message.data,
-            'friend': serialized_friend.data
+            'friend': serialized_friend.data,
+            'next': next_cursor
         }
 
-        self.send_group(user.username, 'message.list', data)
+    @router.route('message.read', connectionId=required(int), messageId=required(int))
+    async def receive_message_read(self, data):
+        user = self.scope['user']
+        result = await self.mark_read(user, data.get('connectionId'), data.get('messageId'))
+        if result is None:
+            return
+        friend_username, receipt, entry = result
+
+        # The reader's other devices and the friend (as a read receipt)
+        await self.send_groups([
+            (user.username, 'message.read', receipt),
+            (friend_username, 'message.read', receipt),
+        ])
+        await self.update_inbox(entry)
+
+    @db_batch
+    def mark_read(self, user, connectionId, messageId):
+        try:
+            connection = Connection.objects.select_related('sender', 'receiver').get(
+                Q(sender=user) | Q(receiver=user),
+                pk=connectionId,
+                accepted=True
+            )
+        except Connection.DoesNotExist:
+            logger.debug('connection not found', extra={'connection_id': connectionId, 'user_id': user.pk})
+            return None
+
+        # Nothing past the newest message can have been read. With
+        # write-behind that may not be flushed yet: the flush leaves it read
+        field = connection.read_field(user.pk)
+        newest = connection.last_message_id or 0
+        if writebehind.enabled():
+            newest = max(newest, writebehind.id_ceiling())
+        read = min(messageId, newest)
+        # Reading up to the newest message is the usual case and needs no count
+        unread = 0
+        if read < (connection.last_message_id or 0):
+            unread = Message.objects.filter(connection=connection, id__gt=read).exclude(user=user).count()
+        # Forward only, whatever order reads from several devices land in
+        if not Connection.objects.filter(pk=connection.pk, **{f'{field}__lt': read}).update(
+            **{field: read, connection.unread_field(user.pk): unread, 'updated': timezone.now()}
+        ):
+            return None
+        setattr(connection, field, read)
+        setattr(connection, connection.unread_field(user.pk), unread)
+
+        friend = connection.receiver if connection.sender_id == user.pk else connection.sender
+        receipt = {'connectionId': connection.id, 'messageId': read, 'username': user.username, 'unread': unread}
+        return friend.username, receipt, inbox.connection_entry(connection)
+
+    @router.route('typing', connectionId=required(int))
+    async def receive_typing(self, data):
+        connection_id = data.get('connectionId')
+        # One event per conversation per TYPING_INTERVAL; a fast typist's
+        # keystrokes in between are covered by the one already sent
+        now = time.monotonic()
+        if now - self.typing_sent.get(connection_id, float('-inf')) < TYPING_INTERVAL:
+            return
+        self.typing_sent[connection_id] = now
+
+        user = self.scope['user']
+        peer = await self.get_peer(user, connection_id)
+        if peer is None:
+            return
+        await self.send_group(peer[1], 'typing', {
+            'connectionId': connection_id,
+            'username': user.username
+        })
+
+    async def get_peer(self, user, connection_id):
+        '''
+        (friend id, username) on an accepted connection of user's, looked up
+        once per socket.
+        '''
+        peer = self.peers.get(connection_id)
+        if peer is None:
+            peer = await self.load_peer(user, connection_id)
+            if peer is not None:
+                self.peers[connection_id] = peer
+        return peer
+
+    @db_batch
+    def load_peer(self, user, connectionId):
+        connection = Connection.objects.filter(
+            Q(sender=user) | Q(receiver=user),
+            pk=connectionId,
+            accepted=True
+        ).values('sender_id', 'sender__username', 'receiver_id', 'receiver__username').first()
+        if connection is None:
+            return None
+        if connection['sender_id'] == user.pk:
+            return connection['receiver_id'], connection['receiver__username']
+        return connection['sender_id'], connection['sender__username']
+
+    @router.route('sync', since=optional(str), connections=optional(dict))
+    async def receive_sync(self, data):
+        user = self.scope['user']
+        try:
+            since = sync.parse_since(data.get('since'))
+            seen = sync.parse_seen(data.get('connections'))
+        except sync.InvalidWatermark as e:
+            await self.send_error(f'Invalid sync {e.field}', code='invalid_field', field=e.field, request='sync')
+            return
+        changes = await self.get_changes(user, since, seen)
+        # Watermarks belong to one device, so only this socket gets the frame
+        await self.send(text_data=codec.dumps({'source': 'sync', 'data': changes}))
+
+    @db_batch
+    def get_changes(self, user, since, seen):
+        return sync.changes(user, since, seen)
 
+    @router.route('presence')
+    async def receive_presence(self, data):
+        user = self.scope['user']
+        friends = (await presence.get_friends([user.pk]))[user.pk]
+        online = set()
+        if presence.enabled():
+            online = await presence.safely(presence.online([friend_id for friend_id, _ in friends])) or set()
+        # Changes arrive as presence frames too; this is the starting point
+        await self.send(text_data=codec.dumps({
+            'source': 'presence',
+            'data': {username: friend_id in online for friend_id, username in friends}
+        }))
 
-    def receive_friends_list(self, data): 
+    @router.route('friends.list', offset=optional(int), pageSize=optional(int))
+    async def receive_friends_list(self, data):
         user = self.scope['user']
-        # Latest message 
-        latest_message = Message.objects.filter(connection=OuterRef('id')).order_by('-created')[:1]
-      
+        friends = await self.read_inbox(user, 'friends', data.get('offset'), data.get('pageSize'))
+        await self.send_group(user.username, 'friends.list', friends)
+
+    @db_batch
+    def get_friends_list(self, user):
+        # Most recent activity first, friends loaded in the same query
         connections = Connection.objects.filter(
-            Q(sender=user, accepted=True) | Q(receiver=user, accepted=True)
-        ).annotate(
-            latest_text=latest_message.values('text'),
-            latest_created=latest_message.values('created')
+            Q(sender=user) | Q(receiver=user),
+            accepted=True
+        ).select_related(
+            'sender', 'receiver'
         ).order_by(
-            Coalesce('latest_created', 'updated')
+            '-last_created'
         )
-        
-        serialized = FriendSerializer(connections, context={'user': user}, many=True)
-        self.send_group(user.username, 'friends.list', serialized.data)
 
-    def receive_request_accept(self, data):
-        username = data.get('username')
+        return FriendSerializer(connections, context={'user': user}, many=True).data
+
+    @router.route('request.accept', username=required(str))
+    async def receive_request_accept(self, data):
+        result = await self.accept_request(data.get('username'), self.scope['user'])
+        if result is None:
+            return
+        sender_username, receiver_username, connection_data, entry = result
+
+        #Send to both users
+        await self.send_groups([
+            (sender_username, 'request.accept', connection_data),
+            (receiver_username, 'request.accept', connection_data),
+        ])
+        await self.update_inbox(entry)
+
+    @db_batch
+    def accept_request(self, username, user):
         try:
-            connection = Connection.objects.get(
+            connection = Connection.objects.select_related('sender', 'receiver').get(
                 sender__username = username,
-                receiver = self.scope['user']
+                receiver = user
             )
         except Connection.DoesNotExist:
-            print('Error: connection does not exist')
-            return
+            logger.debug('request not found', extra={'username': username, 'user_id': user.pk})
+            return None
 
-        connection.accepted = True 
+        connection.accepted = True
+        # A fresh friendship goes to the top of both inboxes
+        connection.last_created = timezone.now()
         connection.save()
 
         serialized = RequestSerializer(connection)
+        return connection.sender.username, connection.receiver.username, serialized.data, inbox.connection_entry(connection)
+
+    @router.route('request.decline', username=required(str))
+    async def receive_request_decline(self, data):
+        result = await self.decline_request(data.get('username'), self.scope['user'])
+        if result is None:
+            return
+        sender_username, receiver_username, connection_data, entry = result
 
-        #Send to both users 
-        self.send_group(connection.sender.username, 'request.accept', serialized.data)
-        self.send_group(connection.receiver.username, 'request.accept', serialized.data)
-        
-    def receive_thumbnail(self, data):
+        await self.send_groups([
+            (sender_username, 'request.decline', connection_data),
+            (receiver_username, 'request.decline', connection_data),
+        ])
+        if inbox.enabled():
+            await inbox.safely(inbox.remove(entry))
+
+    @db_batch
+    def decline_request(self, username, user):
+        try:
+            connection = Connection.objects.select_related('sender', 'receiver').get(
+                sender__username = username,
+                receiver = user,
+                accepted = False
+            )
+        except Connection.DoesNotExist:
+            return None
+
+        serialized = RequestSerializer(connection).data
+        entry = inbox.connection_entry(connection)
+        connection.delete()
+        return connection.sender.username, connection.receiver.username, serialized, entry
+
+    @router.route('thumbnail', base64=required(str), filename=optional(str))
+    async def receive_thumbnail(self, data):
+        # Legacy path: the whole image as base64 inside a JSON frame
+        self.start_thumbnail((images.BASE64, data.get('base64')))
+
+    @router.route('thumbnail.upload', size=required(int), filename=optional(str))
+    async def receive_thumbnail_upload(self, data):
+        # Announces a binary upload; the image follows as bytes frames
+        self.discard_upload()
+        try:
+            self.upload = ChunkedUpload(data.get('filename'), data.get('size'))
+        except UploadTooLarge:
+            await self.send_error(f"Upload exceeds {UPLOAD_MAX_BYTES} bytes")
+        except ValueError as e:
+            await self.send_error(str(e))
+
+    async def receive_bytes(self, bytes_data):
+        upload = self.upload
+        if upload is None:
+            await self.send_error('No upload in progress')
+            return
+        try:
+            await upload.write(bytes_data)
+        except UploadTooLarge:
+            self.discard_upload()
+            await self.send_error('Upload is larger than its declared size')
+            return
+
+        if upload.complete:
+            self.upload = None
+            self.start_thumbnail((images.FILE, upload.path), upload.discard)
+
+    def discard_upload(self):
+        if self.upload is not None:
+            self.upload.discard()
+            self.upload = None
+
+    def start_thumbnail(self, source, cleanup=None):
+        # Resize in the image pool so this socket keeps serving other frames;
+        # the result is reported to every session in the user's group
+        task = asyncio.create_task(self.process_thumbnail(source, cleanup))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def process_thumbnail(self, source, cleanup=None):
         user = self.scope['user']
+        started = time.perf_counter()
 
         try:
-            base64_image = data.get('base64')
-            
-            if ',' in base64_image:
-                base64_image = base64_image.split(',')[1]
-                
-            image_data = base64.b64decode(base64_image)
-            
-            buffer = BytesIO(image_data)
-            image = PILImage.open(buffer)
-            
-            if image.mode == 'RGBA':
-                image = image.convert('RGB')
-                
-            max_size = (400, 400)
-            image.thumbnail(max_size, PILImage.LANCZOS)
-            
-            output_buffer = BytesIO()
-            image.save(output_buffer, format='JPEG', quality=100)
-            output_buffer.seek(0)
-            
-            encoded_image = base64.b64encode(output_buffer.getvalue()).decode('utf-8')
-            
-            output_buffer.seek(0)
-            
-            filename = data.get('filename')
-            if not filename.lower().endswith('.jpg'):
-                filename = os.path.splitext(filename)[0] + '.jpg'
-                
-            user.thumbnail.save(filename, output_buffer, save=True)
-            
-            serialized = UserSerializer(user)
-            user_data = serialized.data
-            
-            user_data['thumbnail_base64'] = f"data:image/jpeg;base64,{encoded_image}"
-            
-            print("Sending user data with base64 thumbnail")
-            
-            # Add detailed logging
-            print("User data structure:", user_data)
-            print("Thumbnail base64 exists:", "thumbnail_base64" in user_data)
-            
-            # Send the data back to the client directly
-            self.send(text_data=json.dumps({
-                'source': 'thumbnail',
-                'user': user_data
-            }))
-            
-            print(f"Image processed and saved successfully: {user.thumbnail.url}")
-            
+            await images.save_avatar(user, source)
+            user_data = self.get_thumbnail_data(user)
+
+            await self.send_group(user.username, 'thumbnail', user_data)
+            logger.info('thumbnail saved', extra={
+                'user_id': user.pk,
+                'digest': user.avatar_hash,
+                'duration_ms': round((time.perf_counter() - started) * 1000, 3),
+            })
+
         except Exception as e:
-            print(f"Error processing image: {str(e)}")
+            logger.exception('thumbnail failed', extra={'user_id': user.pk})
             # Send error back to client
-            self.send(text_data=json.dumps({
-                'error': f"Error processing image: {str(e)}"
-            }))
-    
-    def receive_search(self, data):
-        
-        query = data.get('query')
-        
-        # Search users
-        users = User.objects.filter(
-            Q(username__icontains=query) | Q(first_name__icontains=query) | Q(last_name__icontains=query)
-        ).exclude(
-            username=self.username
-        ).annotate(
-            pending_them=Exists(
-                Connection.objects.filter(
-                    sender=self.scope['user'],
-                    receiver=OuterRef('pk'),
-                    accepted=False
-                )
-            ),
-            pending_me=Exists(
-                Connection.objects.filter(
-                    receiver=self.scope['user'],
-                    sender=OuterRef('pk'),
-                    accepted=False
-                )
-            ),
-            connected=Exists(
-                Connection.objects.filter(
-                    Q(sender=self.scope['user'], receiver=OuterRef('pk'), accepted=True) |
-                    Q(receiver=self.scope['user'], sender=OuterRef('pk'), accepted=True),
-                    accepted=True
-                )
-            )
-        )
-        
-        # Serialize users
-        serialized_users = SearchSerializer(users, many=True).data
-        
-   
+            await self.send_error(f"Error processing image: {str(e)}")
+
+        finally:
+            if cleanup is not None:
+                cleanup()
+
+    def get_thumbnail_data(self, user):
+        # URLs only: avatar paths embed the content digest, so a new upload
+        # is a new URL and clients fetch it (or revalidate) from the media route
+        user_data = UserSerializer(user).data
+        user_data['thumbnail_etag'] = images.user_avatar_etag(user)
+        return user_data
+
+    @router.route('search', query=required(str))
+    async def receive_search(self, data):
+        serialized_users = await self.search_users(data.get('query'), self.scope['user'])
+
         # Send back to client
-        self.send(text_data=json.dumps({
+        await self.send(text_data=codec.dumps({
             'source': 'search',
             'results': serialized_users
         }))
-   
-    def receive_request_connect(self, data):
+
+    @db_batch
+    def search_users(self, query, user):
+        # Ranked, limited page of users from the search index
+        users = search.search_users(query, exclude=user)
+
+        # Serialize users with their connection status resolved in one query
+        statuses = search.connection_statuses(user, users)
+        return SearchSerializer(users, many=True, context={'statuses': statuses}).data
+
+    @router.route('request.connect', username=required(str))
+    async def receive_request_connect(self, data):
         username = data.get('username')
-        print(username)
-        
-        #Attempt to fetch receiver name 
-        try:
-            receiver = User.objects.get(username=username)
-            receiver_serialized = UserSerializer(receiver).data
-        except User.DoesNotExist:
-            print(f"User {username} does not exist")
-            receiver = None
+        user = self.scope['user']
+
+        #Attempt to fetch receiver
+        receiver = await self.get_receiver(username)
+        if receiver is None:
             return
-        
-        # Send back to client
-        self.send(text_data=json.dumps({
+
+        # Send back to client; the profile comes from the cache
+        await self.send(text_data=codec.dumps({
             'source': 'request.connect',
-            'receiver': receiver_serialized
+            'receiver': FriendUserSerializer(receiver).data
         }))
 
-        # Create connection
-        connection, _ = Connection.objects.get_or_create(
-            sender = self.scope['user'],
-            receiver = receiver
-        )
+        connection_data, entry = await self.create_request(user, receiver)
 
-        serialized = RequestSerializer(connection)
+        await self.send_groups([
+            (user.username, 'request.connect', connection_data),
+            (username, 'request.connect', connection_data),
+        ])
+        await self.update_inbox(entry)
+
+    @db_batch
+    def get_receiver(self, username):
+        try:
+            receiver = User.objects.get(username=username)
+        except User.DoesNotExist:
+            logger.debug('user not found', extra={'username': username})
+            return None
+        return receiver
+
+    @db_batch
+    def create_request(self, user, receiver):
+        # One probe on the pair key: an existing connection in either
+        # direction is returned rather than a mirror image created
+        connection, _ = Connection.objects.between(user, receiver).select_related(
+            'sender', 'receiver'
+        ).get_or_create(defaults={'sender': user, 'receiver': receiver})
+        return RequestSerializer(connection).data, inbox.connection_entry(connection)
+
+    @router.route('request.list')
+    async def receive_request_list(self, data):
+        user = self.scope['user']
+        requests = await self.read_inbox(user, 'requests')
 
-        self.send_group(connection.sender.username, 'request.connect', serialized.data)
+        await self.send_group(user.username, 'request.list', requests)
 
-        self.send_group(connection.receiver.username, 'request.connect', serialized.data)
-    # Catch broadcast to client helpers 
+    @db_batch
+    def get_request_list(self, user):
+        connections = Connection.objects.filter(
+            receiver=user, accepted=False
+        ).select_related('sender', 'receiver')
 
-    def receive_request_list(self, data):
-        user = self.scope['user']
-        connections = Connection.objects.filter(receiver=user, accepted=False)
-        
-        serialized = RequestSerializer(connections, many=True)
+        return RequestSerializer(connections, many=True).data
+
+    #----------------------
+    #   Inbox
+    #----------------------
+
+    async def read_inbox(self, user, kind, start=0, size=None):
+        '''
+        friends.list or request.list rows, from the Redis inbox when it's
+        there, else from the DB (loading the inbox on the way).
+        '''
+        start, size = inbox.page_bounds(start, size)
+        if not inbox.enabled():
+            rows = await (self.get_friends_list(user) if kind == 'friends' else self.get_request_list(user))
+            return rows[start:None if size is None else start + size]
+
+        key = inbox.inbox_key(user.pk) if kind == 'friends' else inbox.requests_key(user.pk)
+        entries = await inbox.safely(inbox.read(user.pk, key, start, size))
+        if entries is None:
+            friends, requests = await self.get_inbox_entries(user)
+            await inbox.safely(inbox.build(user.pk, friends, requests))
+            entries = (friends if kind == 'friends' else requests)[start:None if size is None else start + size]
+
+        # Profiles by id: this process's cache first, a DB hop for the rest
+        if kind == 'friends':
+            ids = [inbox.other_id(entry, user.pk) for entry in entries]
+        else:
+            ids = [entry['sender_id'] for entry in entries] + [user.pk]
+        found, missing = profiles.local_profiles(ids, FriendUserSerializer)
+        if missing:
+            found.update(await self.get_profiles(missing))
+
+        if kind == 'friends':
+            return [
+                inbox.friend_row(entry, found[inbox.other_id(entry, user.pk)], user.pk)
+                for entry in entries if inbox.other_id(entry, user.pk) in found
+            ]
+        return [inbox.request_row(entry, found) for entry in entries if entry['sender_id'] in found]
+
+    @db_batch
+    def get_inbox_entries(self, user):
+        friends = Connection.objects.filter(
+            Q(sender=user) | Q(receiver=user),
+            accepted=True
+        ).order_by('-last_created')
+        requests = Connection.objects.filter(
+            receiver=user, accepted=False
+        ).order_by('-created')
+        return (
+            [inbox.connection_entry(connection) for connection in friends],
+            [inbox.connection_entry(connection) for connection in requests],
+        )
 
-        self.send_group(user.username, 'request.list', serialized.data)
-        
-    def send_group(self, group, source, data):
+    @db_batch
+    def get_profiles(self, ids):
+        return profiles.get_profiles(ids, FriendUserSerializer)
+
+    async def update_inbox(self, entry):
+        if inbox.enabled():
+            await inbox.safely(inbox.update(entry))
+
+    # Catch broadcast to client helpers
+
+    async def send_error(self, message, code=None, field=None, request=None):
+        error = {'error': message}
+        # Structured details for protocol errors; 'source' is left out so
+        # clients don't route the error to that source's handler
+        if code is not None:
+            error['code'] = code
+        if field is not None:
+            error['field'] = field
+        if request is not None:
+            error['request'] = request
+        await self.send(text_data=codec.dumps(error))
+
+    async def send_group(self, username, source, data):
         reponse = {
             'type': 'broadcast_group',
             'source': source,
             'data': data
         }
-        async_to_sync(self.channel_layer.group_send)(
-            group, reponse
-        )
-    
-    def broadcast_group(self, data):
+        with metrics.timed(metrics.LAYER_SEND_SECONDS, operation='group_send'):
+            await self.channel_layer.group_send(
+                user_group(username), reponse
+            )
+
+    async def send_groups(self, messages):
+        '''
+        messages: list of (username, source, data), sent as one batch
+        '''
+        with metrics.timed(metrics.LAYER_SEND_SECONDS, operation='group_send_many'):
+            await group_send_many(self.channel_layer, [
+                (user_group(username), {
+                    'type': 'broadcast_group',
+                    'source': source,
+                    'data': data
+                })
+                for username, source, data in messages
+            ])
+
+    async def broadcast_group(self, data):
         '''
-        data: 
+        data:
             - type: broadcast_group
-            - source: where it originated from 
+            - source: where it originated from
             - data: whatever you want to send as a dictionary
         '''
         data.pop('type')
         # only send the source + data
-        self.send(text_data=json.dumps(data))
\ No newline at end of file
+        await self.send(text_data=codec.dumps(data))
@@ -0,0 +1,45 @@
+import asyncio
+import functools
+import weakref
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import connection
+
+from . import metrics
+
+# Max number of ORM batches a single process may have in flight at once
+DB_CONCURRENCY = getattr(settings, 'CHAT_DB_CONCURRENCY', 8)
+
+_slots = weakref.WeakKeyDictionary()
+
+
+def _get_slots():
+    # Semaphores are bound to the loop they are first awaited on
+    loop = asyncio.get_running_loop()
+    slots = _slots.get(loop)
+    if slots is None:
+        slots = _slots[loop] = asyncio.Semaphore(DB_CONCURRENCY)
+    return slots
+
+
+def db_batch(func):
+    '''
+    Run a sync function doing ORM work as one database_sync_to_async hop.
+
+    Handlers should do all their queries and serialization inside a single
+    batch and hand plain data back to the event loop.
+    '''
+    def counted(*args, **kwargs):
+        # Attribute the batch's queries to the frame being handled
+        with connection.execute_wrapper(metrics.count_queries):
+            return func(*args, **kwargs)
+
+    call = database_sync_to_async(counted)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        async with _get_slots():
+            return await call(*args, **kwargs)
+
+    return wrapper
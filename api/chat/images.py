@@ -0,0 +1,232 @@
+import asyncio
+import base64
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils.http import quote_etag
+from PIL import Image as PILImage
+
+# Worker processes for image work; 0 runs it on a thread instead
+IMAGE_WORKERS = getattr(settings, 'CHAT_IMAGE_WORKERS', 2)
+THUMBNAIL_SIZE = (400, 400)
+THUMBNAIL_QUALITY = getattr(settings, 'CHAT_THUMBNAIL_QUALITY', 85)
+
+# Avatar variants rendered once per distinct upload, largest first
+AVATAR_VARIANTS = {
+    'large': THUMBNAIL_SIZE,
+    'medium': (160, 160),
+    'small': (64, 64),
+}
+AVATAR_FORMATS = {
+    'jpeg': ('JPEG', 'jpg'),
+    'webp': ('WEBP', 'webp'),
+}
+AVATAR_ROOT = 'avatars'
+
+# Image sources handed to workers: (kind, value)
+BASE64 = 'base64'
+BYTES = 'bytes'
+FILE = 'file'
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        # forkserver: don't fork a copy of a running server into each worker
+        _pool = ProcessPoolExecutor(
+            max_workers=IMAGE_WORKERS,
+            mp_context=multiprocessing.get_context('forkserver')
+        )
+    return _pool
+
+
+def decode_data_url(data):
+    # Accept both bare base64 and data:image/...;base64, URLs
+    if ',' in data:
+        data = data.split(',', 1)[1]
+    return base64.b64decode(data)
+
+
+def open_source(source):
+    kind, value = source
+    if kind == FILE:
+        # Pillow reads from the file as it decodes, so the upload is never
+        # held in memory as a whole
+        return open(value, 'rb')
+    if kind == BASE64:
+        value = decode_data_url(value)
+    return BytesIO(value)
+
+
+def upload_source(upload):
+    # Spooled uploads are read from disk by the worker
+    if hasattr(upload, 'temporary_file_path'):
+        return (FILE, upload.temporary_file_path())
+    return (BYTES, upload.read())
+
+
+def source_digest(source):
+    '''
+    sha256 of the uploaded image bytes, read in chunks.
+    '''
+    digest = hashlib.sha256()
+    with open_source(source) as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def open_image(image_data, size):
+    image = PILImage.open(image_data)
+    # Let the JPEG decoder skip straight to the nearest 1/2, 1/4 or 1/8 scale
+    image.draft('RGB', size)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image
+
+
+def encode(image, image_format, quality=THUMBNAIL_QUALITY):
+    output = BytesIO()
+    if image_format == 'JPEG':
+        image.save(output, format='JPEG', quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(output, format=image_format, quality=quality, method=4)
+    return output.getvalue()
+
+
+def make_thumbnail(image_data, size=THUMBNAIL_SIZE, quality=THUMBNAIL_QUALITY):
+    '''
+    Downscale an encoded image (bytes or a binary file) to fit size and
+    return it as JPEG bytes. Runs in a worker process.
+    '''
+    if isinstance(image_data, bytes):
+        image_data = BytesIO(image_data)
+    image = open_image(image_data, size)
+    image.thumbnail(size, PILImage.LANCZOS, reducing_gap=3.0)
+    return encode(image, 'JPEG', quality)
+
+
+def render_variants(source):
+    '''
+    Decode once and render every avatar variant in every format.
+
+    Returns {(variant, format): bytes}. Runs in a worker process.
+    '''
+    rendered = {}
+    with open_source(source) as f:
+        image = open_image(f, AVATAR_VARIANTS['large'])
+        # Each variant is scaled down from the previous, larger one
+        for variant, size in AVATAR_VARIANTS.items():
+            image.thumbnail(size, PILImage.LANCZOS, reducing_gap=3.0)
+            for name, (image_format, _) in AVATAR_FORMATS.items():
+                rendered[(variant, name)] = encode(image, image_format)
+    return rendered
+
+
+async def run_in_pool(func, *args):
+    '''
+    Run a picklable image function off the event loop.
+    '''
+    if not IMAGE_WORKERS:
+        return await sync_to_async(func, thread_sensitive=False)(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_pool(), func, *args)
+
+
+def run_in_pool_sync(func, *args):
+    # For sync views: the request thread waits, but the work still runs
+    # in a worker process
+    if not IMAGE_WORKERS:
+        return func(*args)
+    return get_pool().submit(func, *args).result()
+
+
+#----------------------
+#   Avatar storage
+#----------------------
+
+def avatar_path(digest, variant='large', image_format='jpeg'):
+    extension = AVATAR_FORMATS[image_format][1]
+    return f'{AVATAR_ROOT}/{digest[:2]}/{digest}/{variant}.{extension}'
+
+
+def avatar_url(user, variant='large', image_format='jpeg'):
+    if user.avatar_hash:
+        return default_storage.url(avatar_path(user.avatar_hash, variant, image_format))
+    # Avatars saved before variants existed only have the one JPEG
+    if user.thumbnail and image_format == 'jpeg':
+        return user.thumbnail.url
+    return None
+
+
+def avatar_etag(path):
+    # The validator the media route sends for an avatar file: the path
+    # below AVATAR_ROOT, which already names the content
+    return quote_etag(path.split('/', 2)[2].replace('/', '-'))
+
+
+def user_avatar_etag(user, variant='large', image_format='jpeg'):
+    # Matches avatar_url(user, variant, image_format)
+    if user.avatar_hash:
+        return avatar_etag(avatar_path(user.avatar_hash, variant, image_format))
+    return None
+
+
+def avatar_stored(digest):
+    return all(
+        default_storage.exists(avatar_path(digest, variant, image_format))
+        for variant in AVATAR_VARIANTS
+        for image_format in AVATAR_FORMATS
+    )
+
+
+def store_avatar(user, digest, rendered=None):
+    '''
+    Point user at the avatar with this digest, writing any missing
+    variants.
+
+    The avatar it replaces is left in place: another upload of the same
+    image may be about to reuse its files, and checking for that and
+    deleting can't be done atomically here. `manage.py gc_thumbnails`
+    removes avatars nobody refers to.
+    '''
+    for (variant, image_format), data in (rendered or {}).items():
+        path = avatar_path(digest, variant, image_format)
+        if default_storage.exists(path):
+            continue
+        saved = default_storage.save(path, ContentFile(data))
+        if saved != path:
+            # Lost a race with an identical upload
+            default_storage.delete(saved)
+
+    user.avatar_hash = digest
+    user.thumbnail.name = avatar_path(digest)
+    user.save(update_fields=['avatar_hash', 'thumbnail'])
+
+
+async def save_avatar(user, source):
+    '''
+    Hash, render (unless already stored) and assign an uploaded avatar.
+    '''
+    digest = await run_in_pool(source_digest, source)
+    rendered = None
+    if not await database_sync_to_async(avatar_stored)(digest):
+        rendered = await run_in_pool(render_variants, source)
+    await database_sync_to_async(store_avatar)(user, digest, rendered)
+
+
+def save_avatar_sync(user, source):
+    digest = run_in_pool_sync(source_digest, source)
+    rendered = None
+    if not avatar_stored(digest):
+        rendered = run_in_pool_sync(render_variants, source)
+    store_avatar(user, digest, rendered)
@@ -0,0 +1,208 @@
+'''
+Per-user inbox (friends.list) and pending requests (request.list) kept in
+Redis, so reading either is a page-sized range read, not a DB query.
+
+    chat:inbox:<user id>      zset of accepted connection ids by last activity
+    chat:requests:<user id>   zset of incoming pending connection ids by age
+    chat:built:<user id>      set once both zsets were loaded from the DB
+    chat:connection:<id>      JSON entry shared by both users of a connection
+
+message.send, message.read, request.connect/accept/decline update these
+in place. A user whose zsets were never built (or expired) is loaded from
+the DB on the next read. Loading merges with ZADD GT and writes entries
+with NX, so it never rolls back an update that raced it. Without Redis
+(or with CHAT_INBOX_REDIS_URL unset) reads fall back to the DB.
+'''
+import asyncio
+import json
+import logging
+import weakref
+
+import redis.asyncio as redis
+from django.conf import settings
+from rest_framework import serializers
+
+from .pagination import page_size
+
+logger = logging.getLogger(__name__)
+
+INBOX_REDIS_URL = getattr(settings, 'CHAT_INBOX_REDIS_URL', None)
+# Seconds an inbox lives without updates before it's reloaded from the DB
+INBOX_TTL = getattr(settings, 'CHAT_INBOX_TTL', 3600)
+
+NO_MESSAGE_PREVIEW = 'You made a connection'
+
+_datetime = serializers.DateTimeField()
+_clients = weakref.WeakKeyDictionary()
+
+
+def enabled():
+    return bool(INBOX_REDIS_URL)
+
+
+def get_client():
+    # redis.asyncio clients are bound to the loop that created them
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(INBOX_REDIS_URL)
+    if client is None:
+        client = clients[INBOX_REDIS_URL] = redis.Redis.from_url(INBOX_REDIS_URL)
+    return client
+
+
+def inbox_key(user_id):
+    return f'chat:inbox:{user_id}'
+
+
+def requests_key(user_id):
+    return f'chat:requests:{user_id}'
+
+
+def built_key(user_id):
+    return f'chat:built:{user_id}'
+
+
+def entry_key(connection_id):
+    return f'chat:connection:{connection_id}'
+
+
+def connection_entry(connection):
+    '''
+    What both inboxes need to know about a connection, minus profiles.
+    '''
+    return {
+        'id': connection.id,
+        'sender_id': connection.sender_id,
+        'receiver_id': connection.receiver_id,
+        'accepted': connection.accepted,
+        'created': _datetime.to_representation(connection.created),
+        'preview': connection.last_text if connection.last_message_id else NO_MESSAGE_PREVIEW,
+        'updated': _datetime.to_representation(connection.last_created),
+        'sender_last_read': connection.sender_last_read,
+        'receiver_last_read': connection.receiver_last_read,
+        'sender_unread': connection.sender_unread,
+        'receiver_unread': connection.receiver_unread,
+        # Sort keys
+        'updated_score': connection.last_created.timestamp(),
+        'created_score': connection.created.timestamp(),
+    }
+
+
+def other_id(entry, user_id):
+    return entry['receiver_id'] if entry['sender_id'] == user_id else entry['sender_id']
+
+
+def last_read(entry, user_id):
+    return entry['sender_last_read'] if entry['sender_id'] == user_id else entry['receiver_last_read']
+
+
+def friend_row(entry, friend, user_id):
+    # Same shape as FriendSerializer
+    return {
+        'id': entry['id'],
+        'friend': friend,
+        'preview': entry['preview'],
+        'updated': entry['updated'],
+        'last_read': last_read(entry, user_id),
+        'friend_last_read': last_read(entry, other_id(entry, user_id)),
+        'unread': entry['sender_unread'] if entry['sender_id'] == user_id else entry['receiver_unread'],
+    }
+
+
+def request_row(entry, profiles):
+    # Same shape as RequestSerializer
+    return {
+        'id': entry['id'],
+        'sender': profiles.get(entry['sender_id']),
+        'receiver': profiles.get(entry['receiver_id']),
+        'created': entry['created'],
+    }
+
+
+def page_bounds(offset, size):
+    '''
+    (start, size) for a list read: the offset no lower than 0, and the
+    size clamped like message.list's, or None for the whole list.
+    '''
+    return max(offset or 0, 0), None if size is None else page_size(size)
+
+
+async def read(user_id, key, start=0, size=None):
+    '''
+    Entries of one of user_id's zsets, newest first, or None when the
+    zsets have to be (re)built from the DB first.
+    '''
+    client = get_client()
+    stop = -1 if size is None else start + size - 1
+    async with client.pipeline(transaction=False) as pipe:
+        pipe.exists(built_key(user_id))
+        pipe.zrevrange(key, start, stop)
+        built, ids = await pipe.execute()
+    if not built:
+        return None
+    if not ids:
+        return []
+
+    values = await client.mget([entry_key(int(member)) for member in ids])
+    if any(value is None for value in values):
+        # An entry expired or its connection was deleted: start over
+        return None
+    return [json.loads(value) for value in values]
+
+
+async def build(user_id, friends, requests):
+    '''
+    Load user_id's zsets from DB entries (friends, then pending requests).
+    '''
+    client = get_client()
+    async with client.pipeline(transaction=False) as pipe:
+        for entry in friends + requests:
+            pipe.set(entry_key(entry['id']), json.dumps(entry), ex=INBOX_TTL, nx=True)
+        if friends:
+            pipe.zadd(inbox_key(user_id), {e['id']: e['updated_score'] for e in friends}, gt=True)
+        if requests:
+            pipe.zadd(requests_key(user_id), {e['id']: e['created_score'] for e in requests}, gt=True)
+        pipe.expire(inbox_key(user_id), INBOX_TTL)
+        pipe.expire(requests_key(user_id), INBOX_TTL)
+        pipe.set(built_key(user_id), 1, ex=INBOX_TTL)
+        await pipe.execute()
+
+
+async def update(entry):
+    '''
+    Record a created, accepted or messaged connection in both users' zsets.
+    '''
+    users = (entry['sender_id'], entry['receiver_id'])
+    async with get_client().pipeline(transaction=False) as pipe:
+        pipe.set(entry_key(entry['id']), json.dumps(entry), ex=INBOX_TTL)
+        if entry['accepted']:
+            for user_id in users:
+                pipe.zadd(inbox_key(user_id), {entry['id']: entry['updated_score']}, gt=True)
+                pipe.expire(inbox_key(user_id), INBOX_TTL)
+            pipe.zrem(requests_key(entry['receiver_id']), entry['id'])
+        else:
+            pipe.zadd(requests_key(entry['receiver_id']), {entry['id']: entry['created_score']}, gt=True)
+            pipe.expire(requests_key(entry['receiver_id']), INBOX_TTL)
+        await pipe.execute()
+
+
+async def remove(entry):
+    '''
+    Forget a declined (deleted) connection.
+    '''
+    async with get_client().pipeline(transaction=False) as pipe:
+        pipe.delete(entry_key(entry['id']))
+        for user_id in (entry['sender_id'], entry['receiver_id']):
+            pipe.zrem(inbox_key(user_id), entry['id'])
+            pipe.zrem(requests_key(user_id), entry['id'])
+        await pipe.execute()
+
+
+async def safely(coroutine):
+    '''
+    Await an inbox operation; None if Redis is unavailable.
+    '''
+    try:
+        return await coroutine
+    except redis.RedisError:
+        logger.warning('inbox cache unavailable', exc_info=True)
+        return None
@@ -0,0 +1,162 @@
+import asyncio
+import bisect
+import collections
+import hashlib
+import logging
+import time
+
+from channels_redis.core import RedisChannelLayer as BaseRedisChannelLayer
+from channels_redis.utils import create_pool
+
+logger = logging.getLogger(__name__)
+
+# Points per host on the hash ring; more evens out the shards
+RING_REPLICAS = 128
+
+
+def user_group(username):
+    '''
+    The channel layer group of a user's sockets. Group names are limited to
+    ASCII letters, digits, hyphens, underscores and periods, under 100
+    characters; usernames may have '@' or '+', and be 150 long.
+    '''
+    return 'user.' + hashlib.blake2b(username.encode(), digest_size=16).hexdigest()
+
+
+def ring_hash(value):
+    if isinstance(value, str):
+        value = value.encode()
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    '''
+    Consistent hashing over named nodes: adding or removing one moves only
+    the keys on its share of the ring.
+    '''
+
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        points = sorted(
+            (ring_hash(f'{node}#{replica}'), index)
+            for index, node in enumerate(nodes)
+            for replica in range(replicas)
+        )
+        self.points = [point for point, _ in points]
+        self.indexes = [index for _, index in points]
+
+    def __call__(self, value):
+        position = bisect.bisect(self.points, ring_hash(value)) % len(self.points)
+        return self.indexes[position]
+
+
+async def group_send_many(layer, messages):
+    '''
+    Send several (group, message) pairs, batching them when the layer can.
+    '''
+    if hasattr(layer, 'group_send_many'):
+        return await layer.group_send_many(messages)
+    await asyncio.gather(*[
+        layer.group_send(group, message) for group, message in messages
+    ])
+
+
+class RedisChannelLayer(BaseRedisChannelLayer):
+    '''
+    channels_redis layer that can deliver to several groups at once.
+
+    group_send costs three round trips per group (trim, member lookup,
+    delivery). group_send_many resolves the members of every group in one
+    pipeline and delivers every message in one script call, per shard.
+
+    With several hosts, groups and process channels are placed on a hash
+    ring keyed by host address rather than by CRC modulo host count, so
+    adding a shard moves only its share of the groups.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ring = HashRing([
+            host.get('address') or f"{host.get('host')}:{host.get('port')}" for host in self.hosts
+        ])
+
+    def create_pool(self, index):
+        host = dict(self.hosts[index])
+        # Receives block in BZPOPMIN for brpop_timeout seconds; redis-py's
+        # default 5s socket timeout would cut them off and kill the consumer
+        host.setdefault('socket_timeout', self.brpop_timeout + 5)
+        return create_pool(host)
+
+    def consistent_hash(self, value):
+        if self.ring_size == 1:
+            return 0
+        # Process channels live with their process: 'specific.<id>!<local>'
+        # goes wherever 'specific.<id>!' does
+        if '!' in value:
+            value = self.non_local_name(value)
+        return self.ring(value)
+
+    group_send_many_lua = """
+        local over_capacity = 0
+        local count = #KEYS
+        local current_time = ARGV[2 * count + 1]
+        local expiry = ARGV[2 * count + 2]
+        for i=1,count do
+            redis.call('ZREMRANGEBYSCORE', KEYS[i], 0, current_time - expiry)
+            if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + count]) then
+                redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+                redis.call('EXPIRE', KEYS[i], expiry)
+            else
+                over_capacity = over_capacity + 1
+            end
+        end
+        return over_capacity
+    """
+
+    async def group_send_many(self, messages):
+        for group, _ in messages:
+            assert self.require_valid_group_name(group), "Group name not valid"
+
+        # Look up the members of every group, one pipeline per shard
+        by_shard = collections.defaultdict(list)
+        for group, message in messages:
+            by_shard[self.consistent_hash(group)].append((group, message))
+
+        members = []
+        for index, pairs in by_shard.items():
+            pipe = self.connection(index).pipeline()
+            for group, _ in pairs:
+                key = self._group_key(group)
+                pipe.zremrangebyscore(key, min=0, max=int(time.time()) - self.group_expiry)
+                pipe.zrange(key, 0, -1)
+            results = await pipe.execute()
+            for (group, message), channels in zip(pairs, results[1::2]):
+                members.append((message, [x.decode('utf8') for x in channels]))
+
+        # Deliver every message to every member, one script call per shard
+        deliveries = collections.defaultdict(list)
+        for message, channel_names in members:
+            (
+                connection_to_channel_keys,
+                channel_keys_to_message,
+                channel_keys_to_capacity,
+            ) = self._map_channel_keys_to_connection(channel_names, message)
+            for index, channel_keys in connection_to_channel_keys.items():
+                for key in channel_keys:
+                    deliveries[index].append((
+                        key,
+                        channel_keys_to_message[key],
+                        channel_keys_to_capacity[key],
+                    ))
+
+        for index, entries in deliveries.items():
+            keys = [key for key, _, _ in entries]
+            args = [message for _, message, _ in entries]
+            args += [capacity for _, _, capacity in entries]
+            args += [time.time(), self.expiry]
+            over_capacity = await self.connection(index).eval(
+                self.group_send_many_lua, len(keys), *keys, *args
+            )
+            if over_capacity:
+                # Dropped: a worker's sockets share one channel key, so this
+                # is its whole backlog (see CHAT_LAYER_CAPACITY)
+                logger.warning('channel layer over capacity', extra={'shard': index, 'dropped': over_capacity})
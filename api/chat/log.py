@@ -0,0 +1,138 @@
+'''
+Logging pieces wired up in settings.LOGGING.
+
+Records are filtered (sampled, redacted) on the calling thread, then handed
+to a queue; formatting and the write to stderr happen on a listener thread
+so a slow terminal or log shipper never stalls the event loop.
+'''
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+import re
+from logging.handlers import QueueListener
+
+from django.conf import settings
+
+# Share of records flagged frame=True that are kept (1.0 keeps all)
+FRAME_SAMPLE_RATE = getattr(settings, 'CHAT_LOG_FRAME_SAMPLE_RATE', 0.01)
+
+REDACTED = '[redacted]'
+# Keys whose values never reach the logs, at any depth
+SENSITIVE_KEYS = frozenset({
+    'password', 'token', 'access', 'refresh', 'authorization', 'cookie',
+    'secret', 'base64',
+})
+SENSITIVE_PATTERNS = [
+    # JWTs: three base64url segments, the first a JSON header
+    re.compile(r'eyJ[\w-]+\.[\w-]+\.[\w-]*'),
+    # token=... in query strings, as the socket URL carries it
+    re.compile(r'(?<=token=)[^&\s]+'),
+]
+
+# LogRecord attributes; anything else on a record came from extra=
+RECORD_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+
+def redact(value):
+    if isinstance(value, str):
+        for pattern in SENSITIVE_PATTERNS:
+            value = pattern.sub(REDACTED, value)
+        return value
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if str(key).lower() in SENSITIVE_KEYS else redact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return type(value)(redact(item) for item in value)
+    return value
+
+
+def extra_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in RECORD_ATTRS}
+
+
+class RedactFilter(logging.Filter):
+    '''
+    Scrub passwords and tokens from the message, its args and extra fields.
+    '''
+
+    def filter(self, record):
+        if isinstance(record.msg, str):
+            record.msg = redact(record.msg)
+        if record.args:
+            record.args = redact(record.args)
+        for key, value in extra_fields(record).items():
+            setattr(record, key, REDACTED if key.lower() in SENSITIVE_KEYS else redact(value))
+        return True
+
+
+class SampleFilter(logging.Filter):
+    '''
+    Keep a fraction of per-frame records; warnings and up always pass.
+    '''
+
+    def __init__(self, rate=None):
+        super().__init__()
+        self.rate = FRAME_SAMPLE_RATE if rate is None else rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not getattr(record, 'frame', False):
+            return True
+        if random.random() >= self.rate:
+            return False
+        record.sample_rate = self.rate
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    '''
+    One JSON object per line, with extra= fields at the top level.
+    '''
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update(extra_fields(record))
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    '''
+    Enqueue records for a listener thread that formats and writes them.
+    '''
+
+    def __init__(self, stream=None):
+        super().__init__(queue.SimpleQueue())
+        self.target = logging.StreamHandler(stream)
+        self.listener = QueueListener(self.queue, self.target)
+        self.listener.start()
+        atexit.register(self.close)
+
+    def setFormatter(self, fmt):
+        # Formatting happens on the listener thread
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Same process, so exc_info can travel as is; only resolve the
+        # message now, in case its args change after this returns
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+            self.target.close()
+        super().close()
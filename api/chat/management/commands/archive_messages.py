@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat import archive
+
+
+class Command(BaseCommand):
+    help = 'Move old messages into compressed archive segments'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            help=f'Archive messages older than this (default: {archive.ARCHIVE_AFTER_DAYS})',
+        )
+        parser.add_argument(
+            '--every',
+            type=float,
+            metavar='SECONDS',
+            help='Keep running, archiving again every SECONDS',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            counts = archive.archive_messages(options['days'])
+            self.stdout.write(self.style.SUCCESS(
+                f'Archived {sum(counts.values())} message(s) from {len(counts)} connection(s)'
+            ))
+            if options['every'] is None:
+                return
+            time.sleep(options['every'])
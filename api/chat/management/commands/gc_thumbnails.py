@@ -0,0 +1,50 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from chat import images
+from chat.models import User
+
+# Where upload_thumbnail used to put one file per upload
+LEGACY_ROOT = 'thumbnails'
+
+
+class Command(BaseCommand):
+    help = 'Delete avatar files no user refers to any more'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='List what would be deleted without deleting it',
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        names = set(User.objects.exclude(thumbnail='').exclude(thumbnail=None).values_list('thumbnail', flat=True))
+        digests = set(User.objects.exclude(avatar_hash='').values_list('avatar_hash', flat=True))
+
+        orphans = []
+        if default_storage.exists(LEGACY_ROOT):
+            _, files = default_storage.listdir(LEGACY_ROOT)
+            orphans += [
+                f'{LEGACY_ROOT}/{name}' for name in files
+                if f'{LEGACY_ROOT}/{name}' not in names
+            ]
+
+        if default_storage.exists(images.AVATAR_ROOT):
+            prefixes, _ = default_storage.listdir(images.AVATAR_ROOT)
+            for prefix in prefixes:
+                stored, _ = default_storage.listdir(f'{images.AVATAR_ROOT}/{prefix}')
+                for digest in stored:
+                    if digest in digests:
+                        continue
+                    _, files = default_storage.listdir(f'{images.AVATAR_ROOT}/{prefix}/{digest}')
+                    orphans += [f'{images.AVATAR_ROOT}/{prefix}/{digest}/{name}' for name in files]
+
+        for path in orphans:
+            if not dry_run:
+                default_storage.delete(path)
+            self.stdout.write(path)
+
+        verb = 'Would delete' if dry_run else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {len(orphans)} orphaned file(s)'))
@@ -0,0 +1,26 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from chat import writebehind
+
+
+class Command(BaseCommand):
+    help = 'Store write-behind messages left in the journal by stopped workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--worker',
+            type=int,
+            help='Only this CHAT_WORKER_ID (default: every journal found)',
+        )
+
+    def handle(self, *args, **options):
+        worker = options['worker']
+        # Workers replay their own journal on start; this is for ids that
+        # won't be started again. File journals of running workers are
+        # skipped (or, with --worker, refused); with Redis journals their
+        # processes must not be running.
+        journal = writebehind.get_journal(worker, recovering=worker is None)
+        count = asyncio.run(writebehind.recover(journal, all_workers=worker is None))
+        self.stdout.write(self.style.SUCCESS(f'Recovered {count} message(s)'))
@@ -0,0 +1,218 @@
+'''
+In-process metrics for the socket protocol, in Prometheus text format.
+
+Values are per process: with several workers, scrape each one. No client
+library or collector is needed to read them; GET /metrics/ shows the lot.
+'''
+import contextvars
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50)
+
+REGISTRY = []
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labels)
+        self.values = {}
+        # Handlers update metrics from the event loop and from DB threads
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels))
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, format_labels(self.labelnames, key), value
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.kind}',
+        ]
+        with self.lock:
+            for name, labels, value in self.samples():
+                lines.append(f'{name}{labels} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Per-bucket (not cumulative) counts, then sum and count
+                state = self.values[key] = [[0] * len(self.buckets), 0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield (
+                    f'{self.name}_bucket',
+                    format_labels(self.labelnames, key, [('le', format_value(bound))]),
+                    cumulative,
+                )
+            yield f'{self.name}_sum', format_labels(self.labelnames, key), total
+            yield f'{self.name}_count', format_labels(self.labelnames, key), count
+
+
+#----------------------
+#   Chat metrics
+#----------------------
+
+FRAMES = Counter('chat_frames_total', 'Socket frames handled, by source.', ['source'])
+FRAME_ERRORS = Counter('chat_frame_errors_total', 'Socket frames whose handler raised, by source.', ['source'])
+FRAMES_REJECTED = Counter('chat_frames_rejected_total', 'Socket frames refused before dispatch, by error code.', ['code'])
+FRAME_SECONDS = Histogram('chat_frame_seconds', 'Handler latency, by source.', ['source'])
+FRAME_QUERIES = Histogram(
+    'chat_frame_queries', 'Database queries per handled frame, by source.', ['source'], QUERY_BUCKETS
+)
+LAYER_SEND_SECONDS = Histogram(
+    'chat_channel_layer_send_seconds', 'Channel layer group send latency, by operation.', ['operation']
+)
+CONNECTIONS = Gauge('chat_open_connections', 'Accepted sockets currently open in this process.')
+CONNECTIONS.set(0)
+
+# Query tally for the frame being handled; db_batch threads inherit it
+_queries = contextvars.ContextVar('chat_frame_queries', default=None)
+
+
+def count_queries(execute, sql, params, many, context):
+    '''
+    connection.execute_wrapper hook feeding the current frame's tally.
+    '''
+    tally = _queries.get()
+    if tally is not None:
+        tally[0] += 1
+    return execute(sql, params, many, context)
+
+
+class FrameStats:
+    '''
+    Time one frame's handler and count its queries:
+
+        with FrameStats(source) as stats:
+            await handler(data)
+    '''
+
+    def __init__(self, source):
+        self.source = source
+        self.tally = [0]
+        self.duration = 0.0
+
+    @property
+    def queries(self):
+        return self.tally[0]
+
+    @property
+    def duration_ms(self):
+        return round(self.duration * 1000, 3)
+
+    def __enter__(self):
+        self.token = _queries.set(self.tally)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.started
+        _queries.reset(self.token)
+        FRAMES.inc(source=self.source)
+        if exc_type is not None:
+            FRAME_ERRORS.inc(source=self.source)
+        FRAME_SECONDS.observe(self.duration, source=self.source)
+        FRAME_QUERIES.observe(self.queries, source=self.source)
+        return False
+
+
+class timed:
+    '''
+    Observe the duration of a with block into a histogram.
+    '''
+
+    def __init__(self, histogram, **labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
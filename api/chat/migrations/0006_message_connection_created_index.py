@@ -0,0 +1,17 @@
+# Generated by Django 6.1.2 on 2026-10-18 08:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_message'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['connection', 'created', 'id'], name='message_conn_created_id_idx'),
+        ),
+    ]
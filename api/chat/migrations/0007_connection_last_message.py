@@ -0,0 +1,57 @@
+# Generated by Django 6.1.2 on 2026-10-18 08:42
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def backfill_last_message(apps, schema_editor):
+    Connection = apps.get_model('chat', 'Connection')
+    Message = apps.get_model('chat', 'Message')
+    for connection in Connection.objects.all().iterator():
+        message = Message.objects.filter(connection=connection).order_by('-created', '-id').first()
+        if message is None:
+            connection.last_created = connection.updated
+        else:
+            connection.last_message = message
+            connection.last_text = message.text[:100]
+            connection.last_created = message.created
+        Connection.objects.filter(pk=connection.pk).update(
+            last_message=connection.last_message,
+            last_text=connection.last_text,
+            last_created=connection.last_created
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_connection_created_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='connection',
+            name='last_created',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message'),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='last_text',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name='connection',
+            index=models.Index(fields=['sender', 'accepted', '-last_created'], name='conn_sender_inbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='connection',
+            index=models.Index(fields=['receiver', 'accepted', '-last_created'], name='conn_receiver_inbox_idx'),
+        ),
+        migrations.RunPython(backfill_last_message, migrations.RunPython.noop),
+    ]
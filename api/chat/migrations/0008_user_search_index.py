@@ -0,0 +1,43 @@
+from django.db import migrations
+
+# Frozen here rather than imported from chat.search, so replaying this
+# migration always builds the index it originally did
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE chat_user_search USING fts5("
+            "username, first_name, last_name, tokenize='trigram')"
+        )
+        schema_editor.execute(
+            'INSERT INTO chat_user_search(rowid, username, first_name, last_name) '
+            'SELECT id, username, first_name, last_name FROM chat_user'
+        )
+    elif schema_editor.connection.vendor == 'postgresql':
+        # Django's icontains compiles to UPPER(col) LIKE UPPER(%s)
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        schema_editor.execute(
+            'CREATE INDEX chat_user_search_trgm ON chat_user USING gin ('
+            'UPPER(username::text) gin_trgm_ops, '
+            'UPPER(first_name::text) gin_trgm_ops, '
+            'UPPER(last_name::text) gin_trgm_ops)'
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS chat_user_search')
+    elif schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS chat_user_search_trgm')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_connection_last_message'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
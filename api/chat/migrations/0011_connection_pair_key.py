@@ -0,0 +1,57 @@
+from django.db import migrations, models
+
+
+def merge_duplicate_pairs(apps, schema_editor):
+    '''
+    Key every connection by its user pair and fold A->B / B->A duplicates
+    into one, keeping an accepted connection over a pending one, then the
+    oldest. Messages move to the survivor.
+    '''
+    Connection = apps.get_model('chat', 'Connection')
+    Message = apps.get_model('chat', 'Message')
+
+    by_pair = {}
+    for connection in Connection.objects.order_by('-accepted', 'id').iterator():
+        low, high = sorted((connection.sender_id, connection.receiver_id))
+        by_pair.setdefault(f'{low}:{high}', []).append(connection)
+
+    for pair, connections in by_pair.items():
+        survivor, duplicates = connections[0], connections[1:]
+        if duplicates:
+            duplicate_ids = [connection.id for connection in duplicates]
+            Message.objects.filter(connection_id__in=duplicate_ids).update(connection=survivor)
+            Connection.objects.filter(id__in=duplicate_ids).delete()
+
+            # Inbox columns follow the newest message across the merged pair
+            message = Message.objects.filter(connection=survivor).order_by('-created', '-id').first()
+            if message is not None:
+                survivor.last_message_id = message.id
+                survivor.last_text = message.text[:100]
+                survivor.last_created = message.created
+        Connection.objects.filter(pk=survivor.pk).update(
+            pair=pair,
+            last_message_id=survivor.last_message_id,
+            last_text=survivor.last_text,
+            last_created=survivor.last_created
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_user_avatar_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='connection',
+            name='pair',
+            field=models.CharField(editable=False, max_length=41, null=True),
+        ),
+        migrations.RunPython(merge_duplicate_pairs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='connection',
+            name='pair',
+            field=models.CharField(editable=False, max_length=41, unique=True),
+        ),
+    ]
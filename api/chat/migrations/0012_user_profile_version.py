@@ -0,0 +1,19 @@
+# Generated by Django 6.1.2 on 2026-10-18 09:05
+
+import chat.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_connection_pair_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='profile_version',
+            field=models.PositiveIntegerField(default=chat.models.new_profile_version),
+        ),
+    ]
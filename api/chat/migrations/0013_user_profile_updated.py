@@ -0,0 +1,19 @@
+# Generated by Django 6.1.2 on 2026-10-18 09:10
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_user_profile_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='profile_updated',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
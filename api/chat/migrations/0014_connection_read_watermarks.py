@@ -0,0 +1,35 @@
+# Generated by Django 6.1.2 on 2026-10-18 09:14
+
+from django.db import migrations, models
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
+
+
+def mark_history_read(apps, schema_editor):
+    '''
+    Existing conversations start out read rather than all unread.
+    '''
+    Connection = apps.get_model('chat', 'Connection')
+    newest = Coalesce(F('last_message_id'), Value(0))
+    Connection.objects.update(sender_last_read=newest, receiver_last_read=newest)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_user_profile_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='connection',
+            name='receiver_last_read',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='sender_last_read',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(mark_history_read, migrations.RunPython.noop),
+    ]
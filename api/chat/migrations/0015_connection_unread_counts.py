@@ -0,0 +1,23 @@
+# Generated by Django 6.1.2 on 2026-10-18 09:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0014_connection_read_watermarks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='connection',
+            name='receiver_unread',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='sender_unread',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 6.1.2 on 2026-10-18 09:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0016_message_created_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255)),
+                ('count', models.PositiveIntegerField()),
+                ('first_created', models.DateTimeField()),
+                ('first_id', models.BigIntegerField()),
+                ('last_created', models.DateTimeField()),
+                ('last_id', models.BigIntegerField()),
+                ('connection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archive_segments', to='chat.connection')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['connection', 'last_created', 'last_id'], name='archive_conn_last_idx')],
+            },
+        ),
+    ]
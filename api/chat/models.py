@@ -1,5 +1,13 @@
-from django.db import models
+import random
+
+from django.db import models, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Greatest, Lower
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
+
+# Length of the message preview kept on Connection for friends.list
+PREVIEW_LENGTH = 100
 
 # Create your models here.
 
@@ -11,8 +19,60 @@ def upload_thumbnail(instance, filename):
     return path
     
 
+def new_profile_version():
+    # Random rather than a counter, so a reset database or a reused id can't
+    # line up with a profile cached for an earlier row
+    return random.getrandbits(31)
+
+
 class User(AbstractUser):
+    # Points at the large JPEG variant of the current avatar
     thumbnail = models.ImageField(upload_to=upload_thumbnail, null=True, blank=True)
+    # sha256 of the uploaded image; avatar variants are stored under it
+    avatar_hash = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    # Changes whenever a field shown in profiles changes (see chat.profiles)
+    profile_version = models.PositiveIntegerField(default=new_profile_version)
+    # When it last changed, for clients syncing from a watermark
+    profile_updated = models.DateTimeField(default=timezone.now)
+
+    PROFILE_FIELDS = ('username', 'first_name', 'last_name', 'thumbnail', 'avatar_hash')
+
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Search queries too short for trigrams range-scan these
+            models.Index(Lower('username'), name='user_username_lower_idx'),
+            models.Index(Lower('first_name'), name='user_first_name_lower_idx'),
+            models.Index(Lower('last_name'), name='user_last_name_lower_idx'),
+        ]
+
+    def save(self, *args, update_fields=None, **kwargs):
+        if update_fields is None or set(update_fields) & set(self.PROFILE_FIELDS):
+            self.profile_version = new_profile_version()
+            self.profile_updated = timezone.now()
+            if update_fields is not None:
+                update_fields = [*update_fields, 'profile_version', 'profile_updated']
+        super().save(*args, update_fields=update_fields, **kwargs)
+
+def pair_key(user_id, other_id):
+    '''
+    The same key for both directions of a relationship: ordered user ids.
+    '''
+    low, high = sorted((int(user_id), int(other_id)))
+    return f'{low}:{high}'
+
+
+class ConnectionQuerySet(models.QuerySet):
+
+    def bulk_create(self, objs, *args, **kwargs):
+        # save() isn't called for these, so fill the pair key here
+        objs = list(objs)
+        for obj in objs:
+            obj.pair = pair_key(obj.sender_id, obj.receiver_id)
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def between(self, user, other):
+        return self.filter(pair=pair_key(user.pk, other.pk))
+
 
 class Connection(models.Model):
     sender = models.ForeignKey(
@@ -28,9 +88,76 @@ class Connection(models.Model):
     accepted = models.BooleanField(default=False)
     updated = models.DateTimeField(auto_now=True)
     created = models.DateTimeField(auto_now_add=True)
-    
+    # pair_key(sender, receiver): at most one connection per two users,
+    # whoever sent the request
+    pair = models.CharField(max_length=41, unique=True, editable=False)
+
+    # Denormalized from the latest Message so friends.list needs no subqueries.
+    # last_created starts at connection time so new friends sort sensibly.
+    last_message = models.ForeignKey(
+        'Message',
+        related_name='+',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL
+    )
+    last_text = models.CharField(max_length=PREVIEW_LENGTH, blank=True, default='')
+    last_created = models.DateTimeField(default=timezone.now)
+
+    # Read watermarks: id of the newest message each side has read. Only
+    # ever move forward; a user's own messages count as read.
+    sender_last_read = models.BigIntegerField(default=0)
+    receiver_last_read = models.BigIntegerField(default=0)
+    # Messages past each side's watermark, kept as messages arrive so
+    # friends.list never counts rows
+    sender_unread = models.PositiveIntegerField(default=0)
+    receiver_unread = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # friends.list: accepted connections of a user, most recent first
+            models.Index(fields=['sender', 'accepted', '-last_created'], name='conn_sender_inbox_idx'),
+            models.Index(fields=['receiver', 'accepted', '-last_created'], name='conn_receiver_inbox_idx'),
+        ]
+
+    objects = ConnectionQuerySet.as_manager()
+
     def __str__(self):
         return f"{self.sender.username} -> {self.receiver.username}"
+
+    def save(self, *args, **kwargs):
+        self.pair = pair_key(self.sender_id, self.receiver_id)
+        super().save(*args, **kwargs)
+
+    def read_field(self, user_id):
+        '''
+        Name of user_id's read watermark column.
+        '''
+        return 'sender_last_read' if user_id == self.sender_id else 'receiver_last_read'
+
+    def unread_field(self, user_id):
+        return 'sender_unread' if user_id == self.sender_id else 'receiver_unread'
+
+    def record_message(self, message):
+        '''
+        Apply in memory what Message.save wrote to this connection's row.
+        '''
+        newer = self.last_message_id is None or self.last_message_id < message.id
+        if newer:
+            self.last_message_id = message.id
+            self.last_text = message.text[:PREVIEW_LENGTH]
+            self.last_created = message.created
+        author_read = self.read_field(message.user_id)
+        setattr(self, author_read, max(getattr(self, author_read), message.id))
+        if newer:
+            setattr(self, self.unread_field(message.user_id), 0)
+        reader = self.other_id(message.user_id)
+        if getattr(self, self.read_field(reader)) < message.id:
+            unread = self.unread_field(reader)
+            setattr(self, unread, getattr(self, unread) + 1)
+
+    def other_id(self, user_id):
+        return self.receiver_id if user_id == self.sender_id else self.sender_id
         
 class Message(models.Model):
     connection = models.ForeignKey(
@@ -44,7 +171,89 @@ class Message(models.Model):
         on_delete=models.CASCADE
     )
     text = models.TextField()
-    created = models.DateTimeField(auto_now_add=True)
+    # A default rather than auto_now_add, so write-behind can store the
+    # time clients were shown (see chat.writebehind)
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination in message.list walks (created, id) per connection
+            models.Index(fields=['connection', 'created', 'id'], name='message_conn_created_id_idx'),
+        ]
     
     def __str__(self):
-        return f"{self.user.username} -> {self.text}"
\ No newline at end of file
+        return f"{self.user.username} -> {self.text}"
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        if not adding:
+            super().save(*args, **kwargs)
+            return
+        # The row and the connection's columns commit together
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            # Keep the connection's inbox columns pointing at the newest
+            # message, the author's read watermark on it, and count it as
+            # unread for the other side. Concurrent inserts can land out of
+            # order, so an older message leaves newer state alone.
+            newer = Q(last_message__isnull=True) | Q(last_message__lt=self.id)
+            Connection.objects.filter(pk=self.connection_id).update(
+                last_message=Case(
+                    When(newer, then=Value(self.id)),
+                    default=F('last_message'),
+                    output_field=models.BigIntegerField()
+                ),
+                last_text=Case(When(newer, then=Value(self.text[:PREVIEW_LENGTH])), default=F('last_text')),
+                last_created=Case(When(newer, then=Value(self.created)), default=F('last_created')),
+                # Watermarks only move forward; the author's unread count
+                # clears only for their newest message, and the other side
+                # doesn't count one they've already read past
+                sender_last_read=Case(
+                    When(sender_id=self.user_id, then=Greatest(F('sender_last_read'), Value(self.id))),
+                    default=F('sender_last_read'),
+                    output_field=models.BigIntegerField()
+                ),
+                receiver_last_read=Case(
+                    When(receiver_id=self.user_id, then=Greatest(F('receiver_last_read'), Value(self.id))),
+                    default=F('receiver_last_read'),
+                    output_field=models.BigIntegerField()
+                ),
+                sender_unread=Case(
+                    When(newer & Q(sender_id=self.user_id), then=Value(0)),
+                    When(Q(sender_id=self.user_id) | Q(sender_last_read__gte=self.id), then=F('sender_unread')),
+                    default=F('sender_unread') + 1,
+                    output_field=models.PositiveIntegerField()
+                ),
+                receiver_unread=Case(
+                    When(newer & Q(receiver_id=self.user_id), then=Value(0)),
+                    When(Q(receiver_id=self.user_id) | Q(receiver_last_read__gte=self.id), then=F('receiver_unread')),
+                    default=F('receiver_unread') + 1,
+                    output_field=models.PositiveIntegerField()
+                )
+            )
+
+class ArchiveSegment(models.Model):
+    '''
+    Index entry for one compressed file of archived messages (see
+    chat.archive): which connection, how many, and the (created, id) range.
+    '''
+    connection = models.ForeignKey(
+        Connection,
+        related_name='archive_segments',
+        on_delete=models.CASCADE
+    )
+    path = models.CharField(max_length=255)
+    count = models.PositiveIntegerField()
+    first_created = models.DateTimeField()
+    first_id = models.BigIntegerField()
+    last_created = models.DateTimeField()
+    last_id = models.BigIntegerField()
+
+    class Meta:
+        indexes = [
+            # message.list walks a connection's segments newest first
+            models.Index(fields=['connection', 'last_created', 'last_id'], name='archive_conn_last_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.connection_id}: {self.path}'
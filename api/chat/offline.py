@@ -0,0 +1,118 @@
+'''
+message.send frames for users with no open socket, replayed on reconnect.
+
+The channel layer drops a group_send to a user with no sockets, so a
+recipient who is offline (see chat.presence) also gets the frame appended
+to chat:offline:<user id>. This is a Redis stream trimmed to about
+OFFLINE_MAX_LENGTH entries (oldest first), and it expires OFFLINE_TTL
+seconds after the last append. When a socket connects it is sent up to
+OFFLINE_BATCH queued frames at once:
+
+    {'source': 'offline', 'data': {'messages': [...], 'ack': <stream id>, 'more': bool}}
+
+The client answers {'source': 'offline.ack', 'ack': <stream id>}. That
+deletes everything up to the id and sends the next batch if there is more.
+Frames not acknowledged are sent again on the next connect, so clients
+dedupe by message id. A queue that overflowed or expired has lost its
+oldest frames; `sync` catches up from there.
+
+Needs presence: with CHAT_PRESENCE_REDIS_URLS empty nothing is queued.
+'''
+import asyncio
+import json
+import logging
+import re
+import weakref
+
+import redis.asyncio as redis
+from django.conf import settings
+
+from . import presence
+
+logger = logging.getLogger(__name__)
+
+# Redis holding the queues; None turns them off
+OFFLINE_REDIS_URL = getattr(settings, 'CHAT_OFFLINE_REDIS_URL', None)
+# Frames kept per user; older ones are trimmed
+OFFLINE_MAX_LENGTH = getattr(settings, 'CHAT_OFFLINE_MAX_LENGTH', 1000)
+# Seconds a queue lives after its last append
+OFFLINE_TTL = getattr(settings, 'CHAT_OFFLINE_TTL', 7 * 24 * 3600)
+# Frames replayed per offline frame
+OFFLINE_BATCH = getattr(settings, 'CHAT_OFFLINE_BATCH', 200)
+
+STREAM_ID = re.compile(r'^(\d+)-(\d+)$')
+
+_clients = weakref.WeakKeyDictionary()
+
+
+class InvalidAck(ValueError):
+    pass
+
+
+def enabled():
+    return bool(OFFLINE_REDIS_URL) and presence.enabled()
+
+
+def get_client():
+    # redis.asyncio clients are bound to the loop that created them
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(OFFLINE_REDIS_URL)
+    if client is None:
+        client = clients[OFFLINE_REDIS_URL] = redis.Redis.from_url(OFFLINE_REDIS_URL)
+    return client
+
+
+def queue_key(user_id):
+    return f'chat:offline:{user_id}'
+
+
+async def hold(user_id, data):
+    '''
+    Queue a message.send frame's data if the user is offline; True if it was.
+    '''
+    if await presence.online([user_id]):
+        return False
+    key = queue_key(user_id)
+    async with get_client().pipeline(transaction=False) as pipe:
+        pipe.xadd(key, {'data': json.dumps(data)}, maxlen=OFFLINE_MAX_LENGTH, approximate=True)
+        pipe.expire(key, OFFLINE_TTL)
+        await pipe.execute()
+    return True
+
+
+async def pending(user_id):
+    '''
+    The offline frame's data for the oldest queued frames, or None.
+    '''
+    entries = await get_client().xrange(queue_key(user_id), count=OFFLINE_BATCH + 1)
+    if not entries:
+        return None
+    batch = entries[:OFFLINE_BATCH]
+    return {
+        'messages': [json.loads(fields[b'data']) for _, fields in batch],
+        'ack': batch[-1][0].decode(),
+        'more': len(entries) > OFFLINE_BATCH,
+    }
+
+
+async def ack(user_id, stream_id):
+    '''
+    Delete queued frames up to and including stream_id.
+    '''
+    match = STREAM_ID.match(stream_id)
+    if match is None:
+        raise InvalidAck(stream_id)
+    # MINID keeps ids at or above it: start just past the acknowledged one
+    milliseconds, sequence = match.groups()
+    await get_client().xtrim(queue_key(user_id), minid=f'{milliseconds}-{int(sequence) + 1}', approximate=False)
+
+
+async def safely(coroutine):
+    '''
+    Await a queue operation; None if Redis is unavailable.
+    '''
+    try:
+        return await coroutine
+    except redis.RedisError:
+        logger.warning('offline queue unavailable', exc_info=True)
+        return None
@@ -0,0 +1,60 @@
+import base64
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+PAGE_SIZE = getattr(settings, 'CHAT_MESSAGE_PAGE_SIZE', 30)
+MAX_PAGE_SIZE = getattr(settings, 'CHAT_MESSAGE_PAGE_SIZE_MAX', 100)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(message):
+    raw = f'{message.created.isoformat()}|{message.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        created, pk = raw.rsplit('|', 1)
+        created = parse_datetime(created)
+        pk = int(pk)
+    except (ValueError, AttributeError, UnicodeDecodeError):
+        raise InvalidCursor(cursor)
+    if created is None:
+        raise InvalidCursor(cursor)
+    return created, pk
+
+
+def page_size(requested):
+    if requested is None:
+        return PAGE_SIZE
+    try:
+        requested = int(requested)
+    except (TypeError, ValueError):
+        return PAGE_SIZE
+    return max(1, min(requested, MAX_PAGE_SIZE))
+
+
+def paginate_messages(messages, cursor=None, size=None):
+    '''
+    Keyset page over messages, newest first, ordered by (created, id).
+
+    Returns (page, next_cursor); next_cursor is None on the last page.
+    '''
+    size = page_size(size)
+    if cursor:
+        created, pk = decode_cursor(cursor)
+        messages = messages.filter(
+            Q(created__lt=created) | Q(created=created, id__lt=pk)
+        )
+    page = list(messages.order_by('-created', '-id')[:size + 1])
+    next_cursor = None
+    if len(page) > size:
+        page = page[:size]
+        next_cursor = encode_cursor(page[-1])
+    return page, next_cursor
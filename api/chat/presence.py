@@ -0,0 +1,232 @@
+'''
+Who is online, across devices and workers, and telling their friends.
+
+Each user's open sockets are a Redis sorted set, chat:presence:<user id>,
+of channel names scored by expiry time. Users are spread over the
+CHAT_PRESENCE_REDIS_URLS shards by a hash of their id. A user is online
+while any of their sessions hasn't expired. Every worker refreshes its own
+sessions in one pipeline per shard each PRESENCE_HEARTBEAT seconds, so a
+crashed worker's sessions lapse after PRESENCE_TTL.
+
+Online/offline transitions (first session opened, last one closed) are
+not broadcast right away. They are queued per process and flushed every
+PRESENCE_INTERVAL seconds. A flush looks up the friends of every changed
+user in one query and sends each friend a single presence frame
+({username: online}) in one channel layer batch. A reconnect storm costs
+one frame per friend per interval, not one per connect.
+'''
+import asyncio
+import binascii
+import logging
+import math
+import time
+import weakref
+
+import redis.asyncio as redis
+from django.conf import settings
+from django.db.models import Q
+
+from .db import db_batch
+from .layers import group_send_many, user_group
+from .models import Connection
+
+logger = logging.getLogger(__name__)
+
+# Redis shards for session sets; empty turns presence off
+PRESENCE_REDIS_URLS = getattr(settings, 'CHAT_PRESENCE_REDIS_URLS', [])
+# Seconds a session counts as online without a heartbeat
+PRESENCE_TTL = getattr(settings, 'CHAT_PRESENCE_TTL', 60)
+# Seconds between heartbeats; well under PRESENCE_TTL
+PRESENCE_HEARTBEAT = getattr(settings, 'CHAT_PRESENCE_HEARTBEAT', 20)
+# Seconds presence changes are held and merged before broadcasting
+PRESENCE_INTERVAL = getattr(settings, 'CHAT_PRESENCE_INTERVAL', 1.0)
+
+_clients = weakref.WeakKeyDictionary()
+_trackers = weakref.WeakKeyDictionary()
+
+
+def enabled():
+    return bool(PRESENCE_REDIS_URLS)
+
+
+def sessions_key(user_id):
+    return f'chat:presence:{user_id}'
+
+
+def shard(user_id):
+    return binascii.crc32(str(user_id).encode()) % len(PRESENCE_REDIS_URLS)
+
+
+def get_client(index):
+    # redis.asyncio clients are bound to the loop that created them
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    url = PRESENCE_REDIS_URLS[index]
+    client = clients.get(url)
+    if client is None:
+        client = clients[url] = redis.Redis.from_url(url)
+    return client
+
+
+def by_shard(user_ids):
+    shards = {}
+    for user_id in user_ids:
+        shards.setdefault(shard(user_id), []).append(user_id)
+    return shards
+
+
+async def add_session(user_id, session):
+    '''
+    Record an open socket; True if the user just came online.
+    '''
+    now = time.time()
+    key = sessions_key(user_id)
+    async with get_client(shard(user_id)).pipeline(transaction=True) as pipe:
+        pipe.zremrangebyscore(key, 0, now)
+        pipe.zadd(key, {session: now + PRESENCE_TTL})
+        pipe.zcard(key)
+        pipe.expire(key, math.ceil(PRESENCE_TTL))
+        _, _, sessions, _ = await pipe.execute()
+    return sessions == 1
+
+
+async def remove_session(user_id, session):
+    '''
+    Forget a closed socket; True if it was the user's last one.
+    '''
+    key = sessions_key(user_id)
+    async with get_client(shard(user_id)).pipeline(transaction=True) as pipe:
+        pipe.zrem(key, session)
+        pipe.zremrangebyscore(key, 0, time.time())
+        pipe.zcard(key)
+        removed, _, sessions = await pipe.execute()
+    return bool(removed) and sessions == 0
+
+
+async def refresh(sessions):
+    '''
+    Push back the expiry of {session: user id}, one pipeline per shard.
+    '''
+    expires = time.time() + PRESENCE_TTL
+    owners = {}
+    for session, user_id in sessions.items():
+        owners.setdefault(user_id, []).append(session)
+    for index, user_ids in by_shard(owners).items():
+        async with get_client(index).pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                key = sessions_key(user_id)
+                pipe.zadd(key, {session: expires for session in owners[user_id]})
+                pipe.expire(key, math.ceil(PRESENCE_TTL))
+            await pipe.execute()
+
+
+async def online(user_ids):
+    '''
+    The subset of user_ids with a live session.
+    '''
+    now = time.time()
+    found = set()
+    for index, ids in by_shard(user_ids).items():
+        async with get_client(index).pipeline(transaction=False) as pipe:
+            for user_id in ids:
+                pipe.zcount(sessions_key(user_id), now, '+inf')
+            counts = await pipe.execute()
+        found.update(user_id for user_id, count in zip(ids, counts) if count)
+    return found
+
+
+@db_batch
+def get_friends(user_ids):
+    '''
+    {user id: [(friend id, friend username)]} for accepted connections.
+    '''
+    friends = {user_id: [] for user_id in user_ids}
+    rows = Connection.objects.filter(
+        Q(sender_id__in=user_ids) | Q(receiver_id__in=user_ids),
+        accepted=True
+    ).values_list('sender_id', 'sender__username', 'receiver_id', 'receiver__username')
+    for sender_id, sender_username, receiver_id, receiver_username in rows:
+        if sender_id in friends:
+            friends[sender_id].append((receiver_id, receiver_username))
+        if receiver_id in friends:
+            friends[receiver_id].append((sender_id, sender_username))
+    return friends
+
+
+class Tracker:
+    '''
+    This process's sessions and pending presence changes, for one event loop.
+    '''
+
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+        # channel name -> user id
+        self.sessions = {}
+        # user id -> username
+        self.changed = {}
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def connected(self, user, session):
+        self.sessions[session] = user.pk
+        self.start()
+        if await add_session(user.pk, session):
+            self.changed[user.pk] = user.username
+
+    async def disconnected(self, user, session):
+        self.sessions.pop(session, None)
+        if await remove_session(user.pk, session):
+            self.changed[user.pk] = user.username
+
+    async def run(self):
+        next_heartbeat = time.monotonic() + PRESENCE_HEARTBEAT
+        while self.sessions or self.changed:
+            await asyncio.sleep(PRESENCE_INTERVAL)
+            try:
+                if self.changed:
+                    await self.flush()
+                if self.sessions and time.monotonic() >= next_heartbeat:
+                    next_heartbeat = time.monotonic() + PRESENCE_HEARTBEAT
+                    await refresh(dict(self.sessions))
+            except Exception:
+                logger.exception('presence update failed')
+
+    async def flush(self):
+        changed, self.changed = self.changed, {}
+        # Current state rather than the queued transition: a user who left
+        # and came back within the interval is simply online
+        now_online = await online(changed)
+        friends = await get_friends(list(changed))
+
+        frames = {}
+        for user_id, username in changed.items():
+            for _, friend_username in friends[user_id]:
+                frames.setdefault(friend_username, {})[username] = user_id in now_online
+        if not frames:
+            return
+        await group_send_many(self.channel_layer, [
+            (user_group(friend_username), {'type': 'broadcast_group', 'source': 'presence', 'data': data})
+            for friend_username, data in frames.items()
+        ])
+        logger.info('presence broadcast', extra={'users': len(changed), 'frames': len(frames)})
+
+
+def tracker(channel_layer):
+    loop = asyncio.get_running_loop()
+    current = _trackers.get(loop)
+    if current is None:
+        current = _trackers[loop] = Tracker(channel_layer)
+    return current
+
+
+async def safely(coroutine):
+    '''
+    Await a presence operation; None if Redis is unavailable.
+    '''
+    try:
+        return await coroutine
+    except redis.RedisError:
+        logger.warning('presence unavailable', exc_info=True)
+        return None
@@ -0,0 +1,175 @@
+'''
+Serialized user profiles, cached in two tiers.
+
+1. A per-process LRU keyed by (user id, avatar variant).
+2. The Django cache named by CHAT_PROFILE_CACHE_ALIAS (Redis in
+   settings), shared by every worker.
+
+Entries carry the User.profile_version they were built from. A caller
+holding a User row therefore never gets a stale profile: a version
+mismatch is a miss. Lookups by id alone trust an entry until its local
+TTL runs out. Saving a user evicts its local entries and leaves a
+placeholder carrying the new version in the shared tier, so a caller still
+holding the old row can't put its profile back (versions are random, so
+which of two is newer takes a look at the database).
+'''
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_delete
+
+logger = logging.getLogger(__name__)
+
+PROFILE_CACHE_SIZE = getattr(settings, 'CHAT_PROFILE_CACHE_SIZE', 10000)
+# Seconds a local entry is trusted without a version to check it against
+PROFILE_CACHE_TTL = getattr(settings, 'CHAT_PROFILE_CACHE_TTL', 60)
+PROFILE_CACHE_ALIAS = getattr(settings, 'CHAT_PROFILE_CACHE_ALIAS', 'profiles')
+
+VARIANTS = ('large', 'small')
+
+
+class LRUCache:
+    '''
+    Thread-safe LRU of (version, data) with a per-entry expiry.
+    '''
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, version=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            entry_version, data, expires = entry
+            if (version is not None and entry_version != version) or (version is None and expires < time.monotonic()):
+                return None
+            self.entries.move_to_end(key)
+            return data
+
+    def set(self, key, version, data):
+        with self.lock:
+            self.entries[key] = (version, data, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+local = LRUCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+
+def shared_key(user_id, variant):
+    return f'chat:profile:{user_id}:{variant}'
+
+
+def shared_call(method, *args):
+    # The shared tier is an optimisation; chat keeps working without Redis
+    try:
+        return getattr(caches[PROFILE_CACHE_ALIAS], method)(*args)
+    except Exception:
+        logger.warning('profile cache unavailable', exc_info=True)
+        return None
+
+
+def profile(user, variant, render):
+    '''
+    Cached render(user) for a loaded User row.
+    '''
+    key = (user.pk, variant)
+    data = local.get(key, user.profile_version)
+    if data is not None:
+        return data
+
+    entry = shared_call('get', shared_key(*key))
+    if entry is not None and entry['version'] == user.profile_version and entry['data'] is not None:
+        data = entry['data']
+    else:
+        data = render(user)
+        if entry is not None and entry['version'] != user.profile_version and not is_current(user):
+            # The caller's row is older than the database: answer it, but
+            # leave both tiers to the current version
+            return data
+        shared_call('set', shared_key(*key), {'version': user.profile_version, 'data': data})
+    local.set(key, user.profile_version, data)
+    return data
+
+
+def is_current(user):
+    from .models import User
+
+    return User.objects.filter(pk=user.pk, profile_version=user.profile_version).exists()
+
+
+def local_profiles(ids, serializer_class):
+    '''
+    ({id: profile}, [missing ids]) from this process's tier alone; safe to
+    call from the event loop.
+    '''
+    variant = serializer_class.thumbnail_variant
+    found = {}
+    missing = []
+    for user_id in ids:
+        data = local.get((user_id, variant))
+        if data is None:
+            missing.append(user_id)
+        else:
+            found[user_id] = data
+    return found, missing
+
+
+def get_profiles(ids, serializer_class):
+    '''
+    {id: profile} for users known only by id: local tier, then the shared
+    tier, then one query for whatever is left.
+    '''
+    from .models import User
+
+    variant = serializer_class.thumbnail_variant
+    profiles, missing = local_profiles(ids, serializer_class)
+
+    if missing:
+        found = shared_call('get_many', [shared_key(user_id, variant) for user_id in missing]) or {}
+        still_missing = []
+        for user_id in missing:
+            entry = found.get(shared_key(user_id, variant))
+            if entry is None or entry['data'] is None:
+                still_missing.append(user_id)
+                continue
+            local.set((user_id, variant), entry['version'], entry['data'])
+            profiles[user_id] = entry['data']
+
+        # The serializer caches what it renders in both tiers
+        if still_missing:
+            for user in User.objects.filter(pk__in=still_missing):
+                profiles[user.pk] = serializer_class(user).data
+    return profiles
+
+
+def invalidate(sender, instance, update_fields=None, **kwargs):
+    '''
+    post_save / post_delete receiver for User.
+    '''
+    if update_fields is not None and not set(update_fields) & set(sender.PROFILE_FIELDS):
+        return
+    for variant in VARIANTS:
+        local.delete((instance.pk, variant))
+    keys = [shared_key(instance.pk, variant) for variant in VARIANTS]
+    if kwargs.get('signal') is post_delete:
+        shared_call('delete_many', keys)
+    else:
+        shared_call('set_many', {key: {'version': instance.profile_version, 'data': None} for key in keys})
@@ -0,0 +1,152 @@
+import json
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 'json' (stdlib) or 'orjson'
+JSON_CODEC = getattr(settings, 'CHAT_JSON_CODEC', 'json')
+
+
+#----------------------
+#   Codecs
+#----------------------
+
+class JSONCodec:
+    name = 'json'
+
+    @staticmethod
+    def loads(text):
+        return json.loads(text)
+
+    @staticmethod
+    def dumps(data):
+        return json.dumps(data, separators=(',', ':'))
+
+
+class ORJSONCodec:
+    name = 'orjson'
+
+    @staticmethod
+    def loads(text):
+        return orjson.loads(text)
+
+    @staticmethod
+    def dumps(data):
+        # Text frames need str; orjson produces UTF-8 bytes
+        return orjson.dumps(data).decode()
+
+
+CODECS = {
+    JSONCodec.name: JSONCodec,
+    ORJSONCodec.name: ORJSONCodec,
+}
+
+
+def get_codec(name=None):
+    name = name or JSON_CODEC
+    if name not in CODECS:
+        raise ImproperlyConfigured(f'Unknown CHAT_JSON_CODEC {name!r}')
+    if name == ORJSONCodec.name and orjson is None:
+        raise ImproperlyConfigured('CHAT_JSON_CODEC is orjson but orjson is not installed')
+    return CODECS[name]
+
+
+codec = get_codec()
+
+
+#----------------------
+#   Schemas
+#----------------------
+
+class ProtocolError(Exception):
+    '''
+    A frame the consumer can't handle, reported back to the client.
+    '''
+
+    def __init__(self, code, message, field=None, source=None):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.field = field
+        self.source = source
+
+
+Field = namedtuple('Field', ['types', 'required'])
+
+
+def required(*types):
+    return Field(types, True)
+
+
+def optional(*types):
+    return Field(types, False)
+
+
+class Schema:
+    '''
+    Required keys and value types for one source's frames.
+
+    Built once when a handler is registered, so validating a frame is a
+    couple of tuple walks. Keys not in the schema are ignored.
+    '''
+
+    def __init__(self, **fields):
+        self.required = tuple(name for name, field in fields.items() if field.required)
+        self.checks = tuple(
+            (name, field.types, ' or '.join(t.__name__ for t in field.types))
+            for name, field in fields.items()
+        )
+
+    def validate(self, data, source=None):
+        for name in self.required:
+            if data.get(name) is None:
+                raise ProtocolError('missing_field', f'{name} is required', name, source)
+        for name, types, expected in self.checks:
+            value = data.get(name)
+            if value is None:
+                continue
+            # bool is an int subclass, but true isn't a connection id
+            if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+                raise ProtocolError('invalid_field', f'{name} must be {expected}', name, source)
+
+
+#----------------------
+#   Routing
+#----------------------
+
+class Router:
+    '''
+    Maps a frame's source to the consumer method handling it and its schema.
+    '''
+
+    def __init__(self):
+        self.routes = {}
+
+    def route(self, source, **fields):
+        schema = Schema(**fields)
+
+        def decorator(handler):
+            # Stored by name so subclasses can override handlers
+            self.routes[source] = (handler.__name__, schema)
+            return handler
+        return decorator
+
+    def resolve(self, data):
+        '''
+        Name of the handler for a decoded frame, or ProtocolError.
+        '''
+        if not isinstance(data, dict):
+            raise ProtocolError('invalid_frame', 'Frames must be JSON objects')
+        source = data.get('source')
+        try:
+            name, schema = self.routes[source]
+        except (KeyError, TypeError):
+            raise ProtocolError('unknown_source', f'Unknown source {source!r}', 'source')
+        schema.validate(data, source)
+        return name
@@ -0,0 +1,135 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, FloatField, Func, Q, Value
+from django.db.models.functions import Greatest, Lower
+
+from .models import User, Connection, pair_key
+
+# Max users returned per search
+SEARCH_LIMIT = getattr(settings, 'CHAT_SEARCH_LIMIT', 20)
+
+# SQLite FTS5 table (created by migration 0008), kept in sync with chat_user
+# by index_user/unindex_user
+SEARCH_TABLE = 'chat_user_search'
+SEARCHED_FIELDS = ('username', 'first_name', 'last_name')
+
+# Trigram indexes can't answer anything shorter
+TRIGRAM = 3
+
+
+def uses_fts():
+    return connection.vendor == 'sqlite'
+
+
+def rebuild_index(using=connection):
+    if using.vendor != 'sqlite':
+        return
+    with using.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+        cursor.execute(
+            f"INSERT INTO {SEARCH_TABLE}(rowid, {', '.join(SEARCHED_FIELDS)}) "
+            f"SELECT id, {', '.join(SEARCHED_FIELDS)} FROM {User._meta.db_table}"
+        )
+
+
+def index_user(sender, instance, update_fields=None, **kwargs):
+    '''
+    post_save receiver for User.
+    '''
+    if not uses_fts():
+        return
+    if update_fields is not None and not set(update_fields) & set(SEARCHED_FIELDS):
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [instance.pk])
+        cursor.execute(
+            f"INSERT INTO {SEARCH_TABLE}(rowid, {', '.join(SEARCHED_FIELDS)}) VALUES (%s, %s, %s, %s)",
+            [instance.pk] + [getattr(instance, field) for field in SEARCHED_FIELDS]
+        )
+
+
+def unindex_user(sender, instance, **kwargs):
+    '''
+    post_delete receiver for User.
+    '''
+    if not uses_fts():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [instance.pk])
+
+
+def fts_phrase(query):
+    # Quote the whole query so FTS5 treats it as one substring
+    return '"' + query.replace('"', '""') + '"'
+
+
+def search_users(query, exclude=None, limit=None):
+    '''
+    Best matches for query across username, first and last name.
+    '''
+    query = (query or '').strip().lower()
+    limit = limit or SEARCH_LIMIT
+    if not query:
+        return []
+
+    fields = ['id', 'username', 'first_name', 'last_name', 'thumbnail', 'avatar_hash', 'profile_version']
+    exclude_id = exclude.pk if exclude is not None else None
+
+    if len(query) < TRIGRAM:
+        # Too short for trigrams: prefix range scans on the lower() indexes
+        prefix = Q()
+        for field in SEARCHED_FIELDS:
+            prefix |= Q(**{f'{field}_lower__gte': query, f'{field}_lower__lt': query + '\U0010ffff'})
+        users = User.objects.alias(**{
+            f'{field}_lower': Lower(field) for field in SEARCHED_FIELDS
+        }).filter(prefix).order_by('username')
+        if exclude_id is not None:
+            users = users.exclude(pk=exclude_id)
+        return list(users.only(*fields)[:limit])
+
+    if uses_fts():
+        columns = ', '.join(f'u.{field}' for field in fields)
+        return list(User.objects.raw(
+            f'SELECT {columns} FROM {SEARCH_TABLE} s '
+            f'JOIN {User._meta.db_table} u ON u.id = s.rowid '
+            f'WHERE {SEARCH_TABLE} MATCH %s AND s.rowid != %s '
+            f'ORDER BY s.rank LIMIT %s',
+            [fts_phrase(query), exclude_id or 0, limit]
+        ))
+
+    users = User.objects.filter(
+        Q(username__icontains=query) | Q(first_name__icontains=query) | Q(last_name__icontains=query)
+    )
+    if exclude_id is not None:
+        users = users.exclude(pk=exclude_id)
+    if connection.vendor == 'postgresql':
+        users = users.annotate(rank=Greatest(*[
+            Func(F(field), Value(query), function='similarity', output_field=FloatField())
+            for field in SEARCHED_FIELDS
+        ])).order_by('-rank', 'username')
+    else:
+        users = users.order_by('username')
+    return list(users.only(*fields)[:limit])
+
+
+def connection_statuses(user, users):
+    '''
+    Map each user id to its search status relative to user, in one query.
+    '''
+    pairs = [pair_key(user.pk, other.pk) for other in users]
+    statuses = {}
+    if not pairs:
+        return statuses
+    # One unique-index probe per candidate; a pair has at most one row
+    connections = Connection.objects.filter(pair__in=pairs).values_list(
+        'sender_id', 'receiver_id', 'accepted'
+    )
+    for sender_id, receiver_id, accepted in connections:
+        if accepted:
+            other, status = (receiver_id if sender_id == user.pk else sender_id), 'connected'
+        elif sender_id == user.pk:
+            other, status = receiver_id, 'pending-them'
+        else:
+            other, status = sender_id, 'pending-me'
+        statuses[other] = status
+    return statuses
@@ -1,12 +1,31 @@
+import logging
 from typing import override
 from rest_framework import serializers
 from .models import Message, User, Connection
-from django.core.files.base import ContentFile
-import base64
-import os
+from django.core.files.uploadedfile import UploadedFile
+from . import images, profiles
+from .uploads import UPLOAD_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+class ThumbnailField(serializers.Field):
+    '''
+    An avatar sent either as a multipart file or as a base64 data URL.
+    '''
+
+    def to_internal_value(self, data):
+        if isinstance(data, UploadedFile):
+            size = data.size
+        elif isinstance(data, str):
+            size = len(data) * 3 // 4
+        else:
+            raise serializers.ValidationError('Expected an image file or a base64 data URL')
+        if size > UPLOAD_MAX_BYTES:
+            raise serializers.ValidationError(f'Image exceeds {UPLOAD_MAX_BYTES} bytes')
+        return data
 
 class SignUpSeralizer(serializers.ModelSerializer):
-    thumbnail = serializers.CharField(write_only=True, required=False)
+    thumbnail = ThumbnailField(write_only=True, required=False)
 
     class Meta:
         model = User
@@ -32,20 +51,14 @@ class SignUpSeralizer(serializers.ModelSerializer):
         
         if thumbnail_data:
             try:
-                # Extract the base64 data (remove the data:image/jpeg;base64, prefix)
-                format, imgstr = thumbnail_data.split(';base64,')
-                ext = format.split('/')[-1]
-                
-                # Create a ContentFile from the base64 data
-                data = ContentFile(base64.b64decode(imgstr))
-                
-                # Generate a filename
-                filename = f"{username}_avatar.{ext}"
-                
-                # Save the file
-                user.thumbnail.save(filename, data, save=True)
-            except Exception as e:
-                print(f"Error saving thumbnail: {e}")
+                # Resize in the image pool; uploads are read from their temp file
+                if isinstance(thumbnail_data, str):
+                    source = (images.BASE64, thumbnail_data)
+                else:
+                    source = images.upload_source(thumbnail_data)
+                images.save_avatar_sync(user, source)
+            except Exception:
+                logger.exception('thumbnail failed', extra={'user_id': user.pk})
 
         user.set_password(password)
         user.save()
@@ -53,36 +66,49 @@ class SignUpSeralizer(serializers.ModelSerializer):
         
 class UserSerializer(serializers.ModelSerializer):
    name = serializers.SerializerMethodField()
+   thumbnail = serializers.SerializerMethodField()
+   thumbnail_webp = serializers.SerializerMethodField()
+
+   # Avatar variant to link to; list views use the small one
+   thumbnail_variant = 'large'
    
    class Meta:
         model = User
-        fields = ['username', 'name', 'password', 'thumbnail']
+        fields = ['username', 'name', 'thumbnail', 'thumbnail_webp']
+
+   def to_representation(self, instance):
+        # Same user and version, same payload: see chat.profiles
+        return profiles.profile(instance, self.thumbnail_variant, super().to_representation)
     
    def get_name(self, obj):
         fname = obj.first_name.capitalize()
         lname = obj.last_name.capitalize()
         return f'{fname} {lname}'
+
+   def get_thumbnail(self, obj):
+        return images.avatar_url(obj, self.thumbnail_variant)
+
+   def get_thumbnail_webp(self, obj):
+        return images.avatar_url(obj, self.thumbnail_variant, 'webp')
+
+
+class FriendUserSerializer(UserSerializer):
+    thumbnail_variant = 'small'
   
 
-class SearchSerializer(UserSerializer):
-    status = serializers.SerializerMethodField()
-    
-    class Meta:
-        model = User 
-        fields = ['username', 'name', 'thumbnail', 'status']
-
-    def get_status(self, obj):
-        if obj.pending_them:
-            return 'pending-them'
-        elif obj.pending_me:
-            return 'pending-me'
-        elif obj.connected:
-            return 'connected'
-        return 'no-connection'
+class SearchSerializer(FriendUserSerializer):
+
+    def to_representation(self, instance):
+        # The cached profile plus a status that depends on who is searching,
+        # resolved for the whole page up front by search.connection_statuses
+        return {
+            **super().to_representation(instance),
+            'status': self.context['statuses'].get(instance.id, 'no-connection'),
+        }
 
 class RequestSerializer(serializers.ModelSerializer):
-    sender = UserSerializer()
-    receiver = UserSerializer()
+    sender = FriendUserSerializer()
+    receiver = FriendUserSerializer()
     
     class Meta:
         model = Connection
@@ -91,21 +117,42 @@ class RequestSerializer(serializers.ModelSerializer):
 class FriendSerializer(serializers.ModelSerializer):
     friend = serializers.SerializerMethodField()
     preview = serializers.SerializerMethodField()
+    updated = serializers.DateTimeField(source='last_created')
+    last_read = serializers.SerializerMethodField()
+    friend_last_read = serializers.SerializerMethodField()
+    unread = serializers.SerializerMethodField()
     
     class Meta:
         model = Connection
-        fields = ['id', 'friend', 'preview', 'updated']
+        fields = ['id', 'friend', 'preview', 'updated', 'last_read', 'friend_last_read', 'unread']
     
     def get_friend(self, obj): 
-        if self.context['user'] == obj.sender:
-            return UserSerializer(obj.receiver).data
-        elif self.context['user'] == obj.receiver:
-            return UserSerializer(obj.sender).data
+        # Compare ids so rows loaded with select_related cost no extra queries
+        user_id = self.context['user'].id
+        if user_id == obj.sender_id:
+            return FriendUserSerializer(obj.receiver).data
+        elif user_id == obj.receiver_id:
+            return FriendUserSerializer(obj.sender).data
         else: 
             return None   
 
     def get_preview(self, obj): 
-        return 'You made a connection'
+        if obj.last_message_id is None:
+            return 'You made a connection'
+        return obj.last_text
+
+    def get_last_read(self, obj):
+        # Newer messages than this are unread
+        return getattr(obj, obj.read_field(self.context['user'].id))
+
+    def get_friend_last_read(self, obj):
+        # Read receipts: the friend has seen messages up to this id
+        user_id = self.context['user'].id
+        friend_id = obj.receiver_id if user_id == obj.sender_id else obj.sender_id
+        return getattr(obj, obj.read_field(friend_id))
+
+    def get_unread(self, obj):
+        return getattr(obj, obj.unread_field(self.context['user'].id))
 
 class MessageSerializer(serializers.ModelSerializer):
     is_me = serializers.SerializerMethodField()
@@ -115,4 +162,4 @@ class MessageSerializer(serializers.ModelSerializer):
         fields = ['id', 'text', 'created', 'is_me']
         
     def get_is_me(self, obj): 
-        return obj.user == self.context['user']
\ No newline at end of file
+        return obj.user_id == self.context['user'].id
\ No newline at end of file
@@ -0,0 +1,162 @@
+'''
+What changed for a user since a client's watermark, for the sync source.
+
+A client keeps the watermark of its last sync frame and, per connection,
+the id of the newest message it holds. On reconnect it sends both and gets
+one frame with what changed in between:
+
+    friends    accepted connections with new messages, or newly accepted
+    requests   incoming requests made since
+    profiles   connected users whose profile changed (and whose row
+               isn't in friends or requests already)
+    messages   per connection, messages newer than the client's (at most
+               SYNC_MESSAGE_LIMIT, plus a message.list cursor for the rest)
+
+Without a watermark, friends and requests are a full snapshot and messages
+are sent only for connections listed with a message id. Rows are matched
+with SYNC_OVERLAP seconds of slack, because a timestamp is taken before its
+transaction commits; clients de-duplicate by id. Declined requests are
+deleted rows, so they only reach clients live, as request.decline.
+'''
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework import serializers
+
+from .models import Connection, Message
+from .pagination import MAX_PAGE_SIZE, encode_cursor
+from .serializers import FriendSerializer, FriendUserSerializer, MessageSerializer, RequestSerializer
+
+# Newest messages sent per connection; older ones are paged with message.list
+SYNC_MESSAGE_LIMIT = getattr(settings, 'CHAT_SYNC_MESSAGE_LIMIT', MAX_PAGE_SIZE)
+# Seconds subtracted from a watermark before comparing timestamps
+SYNC_OVERLAP = getattr(settings, 'CHAT_SYNC_OVERLAP', 5)
+
+_datetime = serializers.DateTimeField()
+
+
+class InvalidWatermark(ValueError):
+
+    def __init__(self, field):
+        super().__init__(field)
+        self.field = field
+
+
+def parse_since(value):
+    if value is None:
+        return None
+    try:
+        since = parse_datetime(value)
+    except ValueError:
+        since = None
+    if since is None:
+        raise InvalidWatermark('since')
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+def parse_seen(value):
+    '''
+    {connection id: newest message id} from the frame's JSON object.
+    '''
+    if value is None:
+        return {}
+    try:
+        seen = {int(connection_id): message_id for connection_id, message_id in value.items()}
+    except ValueError:
+        raise InvalidWatermark('connections')
+    if not all(isinstance(message_id, int) and not isinstance(message_id, bool) for message_id in seen.values()):
+        raise InvalidWatermark('connections')
+    return seen
+
+
+def newest_messages(conditions):
+    '''
+    Up to SYNC_MESSAGE_LIMIT + 1 messages per connection, newest first, in
+    one query.
+    '''
+    rows = Message.objects.filter(conditions).annotate(
+        row=Window(
+            RowNumber(),
+            partition_by=F('connection_id'),
+            order_by=(F('created').desc(), F('id').desc())
+        )
+    ).filter(row__lte=SYNC_MESSAGE_LIMIT + 1).order_by('connection_id', '-created', '-id')
+
+    by_connection = {}
+    for message in rows:
+        by_connection.setdefault(message.connection_id, []).append(message)
+    return by_connection
+
+
+def changes(user, since=None, seen=None):
+    '''
+    The sync frame's data: two queries whatever the number of connections.
+    '''
+    seen = seen or {}
+    # Taken first, so anything committed while this runs is sent next time
+    watermark = timezone.now()
+
+    connections = Connection.objects.filter(
+        Q(sender=user) | Q(receiver=user)
+    ).select_related('sender', 'receiver')
+    after = None
+    if since is not None:
+        after = since - timedelta(seconds=SYNC_OVERLAP)
+        connections = connections.filter(
+            Q(updated__gt=after)
+            | Q(last_created__gt=after)
+            | Q(sender=user, receiver__profile_updated__gt=after)
+            | Q(receiver=user, sender__profile_updated__gt=after)
+        )
+
+    friends, requests, changed_profiles = [], [], {}
+    conditions = Q()
+    for connection in connections:
+        other = connection.receiver if connection.sender_id == user.pk else connection.sender
+        changed = after is None or connection.updated > after or connection.last_created > after
+
+        if changed and connection.accepted:
+            friends.append(connection)
+        elif changed and connection.receiver_id == user.pk:
+            requests.append(connection)
+        elif after is not None and other.profile_updated > after:
+            changed_profiles[other.pk] = other
+
+        if not connection.accepted:
+            continue
+        # The client's newest message id beats the watermark where it has one
+        if connection.id in seen:
+            if after is None or connection.last_created > after:
+                conditions |= Q(connection_id=connection.id, id__gt=seen[connection.id])
+        elif after is not None and connection.last_created > after:
+            conditions |= Q(connection_id=connection.id, created__gt=after)
+
+    messages = {}
+    if conditions:
+        for connection_id, page in newest_messages(conditions).items():
+            next_cursor = None
+            if len(page) > SYNC_MESSAGE_LIMIT:
+                page = page[:SYNC_MESSAGE_LIMIT]
+                next_cursor = encode_cursor(page[-1])
+            # String keys: JSON objects can't have numeric ones
+            messages[str(connection_id)] = {
+                'messages': MessageSerializer(page, many=True, context={'user': user}).data,
+                'next': next_cursor,
+            }
+
+    friends.sort(key=lambda connection: connection.last_created, reverse=True)
+    requests.sort(key=lambda connection: connection.created, reverse=True)
+    return {
+        'watermark': _datetime.to_representation(watermark),
+        'full': since is None,
+        'friends': FriendSerializer(friends, many=True, context={'user': user}).data,
+        'requests': RequestSerializer(requests, many=True).data,
+        'profiles': FriendUserSerializer(changed_profiles.values(), many=True).data,
+        'messages': messages,
+    }
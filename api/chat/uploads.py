@@ -0,0 +1,70 @@
+import os
+import tempfile
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.uploadhandler import SkipFile, TemporaryFileUploadHandler
+
+# Largest avatar upload accepted, over HTTP or the socket
+UPLOAD_MAX_BYTES = getattr(settings, 'CHAT_UPLOAD_MAX_BYTES', 10 * 1024 * 1024)
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class LimitedTemporaryFileUploadHandler(TemporaryFileUploadHandler):
+    '''
+    Stream multipart file parts to a temp file, refusing anything over the
+    upload limit instead of buffering it.
+    '''
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > UPLOAD_MAX_BYTES:
+            self.file.close()
+            raise SkipFile()
+        return super().receive_data_chunk(raw_data, start)
+
+
+class ChunkedUpload:
+    '''
+    An upload arriving as binary WebSocket frames, spooled to a temp file.
+
+    Created from a thumbnail.upload frame declaring the total size; each
+    binary frame after it is appended until that size is reached.
+    '''
+
+    def __init__(self, filename, size):
+        if not isinstance(size, int) or size <= 0:
+            raise ValueError('Upload size must be a positive integer')
+        if size > UPLOAD_MAX_BYTES:
+            raise UploadTooLarge(size)
+        self.filename = filename or 'thumbnail.jpg'
+        self.size = size
+        self.received = 0
+        self.file = tempfile.NamedTemporaryFile(
+            prefix='upload-', dir=settings.FILE_UPLOAD_TEMP_DIR, delete=False
+        )
+
+    @property
+    def path(self):
+        return self.file.name
+
+    @property
+    def complete(self):
+        return self.received == self.size
+
+    async def write(self, chunk):
+        if self.received + len(chunk) > self.size:
+            raise UploadTooLarge(self.received + len(chunk))
+        await sync_to_async(self.file.write, thread_sensitive=False)(chunk)
+        self.received += len(chunk)
+        if self.complete:
+            await sync_to_async(self.file.close, thread_sensitive=False)()
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -1,7 +1,8 @@
 from django.urls import path 
-from .views import SignInView, SignUpView
+from .views import SignInView, SignUpView, ThumbnailUploadView
 
 urlpatterns = [
     path('signin/', SignInView.as_view(), name='signin'),
-    path('signup/', SignUpView.as_view(), name='signup')
+    path('signup/', SignUpView.as_view(), name='signup'),
+    path('thumbnail/', ThumbnailUploadView.as_view(), name='thumbnail')
 ]
\ No newline at end of file
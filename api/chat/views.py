@@ -1,16 +1,40 @@
+import logging
+
+from django.http import HttpResponse
 from django.shortcuts import render
+from django.views.decorators.http import require_safe
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework.permissions import AllowAny
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.permissions import AllowAny, IsAuthenticated
 from django.contrib.auth import authenticate
 from rest_framework_simplejwt.tokens import RefreshToken
+from . import images, metrics
+from .layers import user_group
 from .serializers import UserSerializer, SignUpSeralizer
+from .uploads import LimitedTemporaryFileUploadHandler, UPLOAD_MAX_BYTES
 from .models import User
 
+logger = logging.getLogger(__name__)
+
+# Room for multipart boundaries and the other form fields
+MULTIPART_OVERHEAD = 64 * 1024
+
+def stream_uploads_to_disk(request):
+    '''
+    Make multipart file parts go straight to a size-limited temp file.
+
+    Returns False when the declared body is already too large to accept.
+    '''
+    if int(request.META.get('CONTENT_LENGTH') or 0) > UPLOAD_MAX_BYTES + MULTIPART_OVERHEAD:
+        return False
+    request.upload_handlers = [LimitedTemporaryFileUploadHandler(request._request)]
+    return True
+
 def get_auth_for_user(user):
     tokens = RefreshToken.for_user(user)
-    print('tokens', tokens)
-    print('token', tokens.access_token)
     return {
         'refresh': str(tokens),
         'access': str(tokens.access_token),
@@ -29,19 +53,22 @@ class SignInView(APIView):
             return Response(status=400, data={"error": "Username and password are required"})
         
         user = authenticate(username=username, password=password)
-        print('user', user)
         if not user:
+            logger.info('sign in failed', extra={'username': username})
             return Response(status=401, data={"error": "Invalid credentials"})
         
         user_data = get_auth_for_user(user)
+        logger.info('sign in', extra={'user_id': user.pk})
 
         return Response(status=200, data=user_data)
 
 class SignUpView(APIView):
     permission_classes = [AllowAny]
+    parser_classes = [JSONParser, MultiPartParser, FormParser]
 
     def post(self, request):
-        print(request.data)
+        if not stream_uploads_to_disk(request):
+            return Response(status=413, data={"error": f"Upload exceeds {UPLOAD_MAX_BYTES} bytes"})
         new_user = SignUpSeralizer(data=request.data)
         new_user.is_valid(raise_exception=True)
         user = new_user.save()
@@ -49,4 +76,38 @@ class SignUpView(APIView):
 
         user_data = get_auth_for_user(user)
 
-        return Response(user_data)
\ No newline at end of file
+        return Response(user_data)
+
+class ThumbnailUploadView(APIView):
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser]
+
+    def post(self, request):
+        if not stream_uploads_to_disk(request):
+            return Response(status=413, data={"error": f"Upload exceeds {UPLOAD_MAX_BYTES} bytes"})
+
+        upload = request.FILES.get('thumbnail')
+        if upload is None:
+            return Response(status=400, data={"error": f"A thumbnail file of at most {UPLOAD_MAX_BYTES} bytes is required"})
+
+        try:
+            images.save_avatar_sync(request.user, images.upload_source(upload))
+        except Exception as e:
+            return Response(status=400, data={"error": f"Error processing image: {e}"})
+
+        user_data = UserSerializer(request.user).data
+        user_data['thumbnail_etag'] = images.user_avatar_etag(request.user)
+
+        # Let the user's open sockets pick up the new avatar
+        async_to_sync(get_channel_layer().group_send)(user_group(request.user.username), {
+            'type': 'broadcast_group',
+            'source': 'thumbnail',
+            'data': user_data
+        })
+        return Response(user_data)
+
+
+@require_safe
+def metrics_view(request):
+    # Prometheus text exposition of this process's chat metrics
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
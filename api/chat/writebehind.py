@@ -0,0 +1,516 @@
+'''
+Write-behind for message.send (CHAT_WRITE_BEHIND).
+
+The default path INSERTs each message before delivering it, so under
+SQLite every send waits for the database write lock. In write-behind mode
+a message instead:
+
+1. gets its id from a Snowflake allocator: milliseconds since EPOCH_MS,
+   then CHAT_WORKER_ID, then a per-millisecond sequence. Ids are unique
+   per worker and increase over time. They start far above the
+   autoincrement ids stored before write-behind was turned on, and each
+   flush moves the database's id sequence past them, so turning it off
+   again keeps new ids increasing;
+2. is appended to this worker's journal (a local file, or a Redis stream);
+3. is delivered to both users right away;
+4. is INSERTed by a background flusher. Each flush writes a batch with
+   bulk_create and applies the connection updates that Message.save would
+   have made, all in one transaction, and then acknowledges the batch in
+   the journal. A batch the database rejects is retried a row at a time;
+   rows it still rejects are logged and dropped.
+
+A worker that dies keeps its unacknowledged batches in the journal, and
+replays them when it starts again, as its first socket connects (or run
+`manage.py recover_messages`).
+Replays skip ids already stored, so a batch committed before the crash is
+not counted twice. Each worker must have its own CHAT_WORKER_ID; there is
+no default, and a file journal refuses an id another process holds.
+
+File journals survive a process crash as soon as a message is appended,
+and a power loss once its batch is sealed (fsync). Redis journals are as
+durable as that server's persistence settings. Until a batch is flushed,
+message.list and friends.list don't show its messages; the flush interval
+bounds that lag. message.read accepts ids up to id_ceiling() meanwhile,
+and a flush doesn't count a message its reader has already read.
+'''
+import asyncio
+import fcntl
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from pathlib import Path
+
+import redis.asyncio as redis
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.color import no_style
+from django.db import DataError, IntegrityError, transaction
+from django.utils.dateparse import parse_datetime
+from rest_framework import serializers
+
+from . import inbox
+from .db import db_batch
+from .models import Connection, Message
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND = getattr(settings, 'CHAT_WRITE_BEHIND', False)
+# 'file' (CHAT_WRITE_BEHIND_DIR) or 'redis' (CHAT_WRITE_BEHIND_REDIS_URL)
+JOURNAL = getattr(settings, 'CHAT_WRITE_BEHIND_JOURNAL', 'file')
+JOURNAL_DIR = getattr(settings, 'CHAT_WRITE_BEHIND_DIR', 'journal')
+JOURNAL_REDIS_URL = getattr(settings, 'CHAT_WRITE_BEHIND_REDIS_URL', None)
+# Messages that trigger a flush without waiting for the interval
+BATCH_SIZE = getattr(settings, 'CHAT_WRITE_BEHIND_BATCH', 500)
+# Seconds between flushes
+INTERVAL = getattr(settings, 'CHAT_WRITE_BEHIND_INTERVAL', 0.05)
+# Seconds to wait before retrying a failed flush
+RETRY_DELAY = getattr(settings, 'CHAT_WRITE_BEHIND_RETRY_DELAY', 1.0)
+# Snowflake worker id, 0-63; unique per process writing messages. No
+# default: two processes sharing one would mint the same ids
+WORKER_ID = getattr(settings, 'CHAT_WORKER_ID', None)
+
+# 2024-01-01T00:00:00Z
+EPOCH_MS = 1704067200000
+# How far another worker's clock may run ahead of this one's
+CLOCK_SKEW_MS = 1000
+# 53 bits in all, so ids survive JSON.parse in browsers (2^53 is the
+# largest exact JavaScript integer); 41 bits of milliseconds last to 2093
+WORKER_BITS = 6
+SEQUENCE_BITS = 6
+
+_datetime = serializers.DateTimeField()
+_writers = weakref.WeakKeyDictionary()
+
+
+def enabled():
+    return WRITE_BEHIND
+
+
+def worker_id():
+    if WORKER_ID is None:
+        raise ImproperlyConfigured('CHAT_WRITE_BEHIND needs a CHAT_WORKER_ID unique to this process')
+    return WORKER_ID
+
+
+class Snowflake:
+    '''
+    53-bit ids: 41 bits of milliseconds, 6 of worker, 6 of sequence.
+    '''
+
+    def __init__(self, worker):
+        if not 0 <= worker < 1 << WORKER_BITS:
+            raise ValueError(f'Worker id must be below {1 << WORKER_BITS}')
+        self.worker = worker
+        self.last = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def next(self):
+        with self.lock:
+            # A clock that went back keeps counting from the last id
+            now = max(int(time.time() * 1000), self.last)
+            if now == self.last:
+                self.sequence = (self.sequence + 1) & ((1 << SEQUENCE_BITS) - 1)
+                if self.sequence == 0:
+                    # 64 ids this millisecond already: borrow the next one
+                    now += 1
+            else:
+                self.sequence = 0
+            self.last = now
+            return ((now - EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker << SEQUENCE_BITS) | self.sequence
+
+
+_snowflake = None
+
+
+def next_id():
+    global _snowflake
+    if _snowflake is None:
+        _snowflake = Snowflake(worker_id())
+    return _snowflake.next()
+
+
+def id_ceiling():
+    '''
+    The largest id any worker can have issued by now, give or take
+    CLOCK_SKEW_MS: the most a client can have been shown.
+    '''
+    now = int(time.time() * 1000) + CLOCK_SKEW_MS
+    return ((now - EPOCH_MS + 1) << (WORKER_BITS + SEQUENCE_BITS)) - 1
+
+
+def new_message(connection_id, user_id, text):
+    '''
+    An unsaved Message with its final id and timestamp, and its journal
+    record.
+    '''
+    message = Message(id=next_id(), connection_id=connection_id, user_id=user_id, text=text)
+    record = {
+        'id': message.id,
+        'connection': connection_id,
+        'user': user_id,
+        'text': text,
+        'created': _datetime.to_representation(message.created),
+    }
+    return message, record
+
+
+def to_message(record):
+    return Message(
+        id=record['id'],
+        connection_id=record['connection'],
+        user_id=record['user'],
+        text=record['text'],
+        created=parse_datetime(record['created']),
+    )
+
+
+#----------------------
+#   Journals
+#----------------------
+
+class FileJournal:
+    '''
+    JSON lines in <directory>/worker-<id>.open. Sealing renames the open
+    segment to worker-<id>.<n>.sealed for the flusher; acking deletes it.
+
+    A journal holds a lock on worker-<id>.lock while its process lives, so
+    a second process with the same worker id fails to start, and recovery
+    leaves a running worker's segments alone. worker None is for
+    recovering others' journals only.
+    '''
+
+    def __init__(self, directory, worker):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.worker = worker
+        self.open_path = self.directory / f'worker-{worker}.open'
+        self.file = None
+        self.sequence = itertools.count()
+        self.lock_file = None
+        if worker is not None:
+            self.lock_file = self.lock(worker)
+            if self.lock_file is None:
+                raise ImproperlyConfigured(f'CHAT_WORKER_ID {worker} is in use by another process')
+
+    def lock(self, worker):
+        '''
+        The open lock file of a worker id, or None if another process holds it.
+        '''
+        # POSIX record locks belong to the process: taking one again here
+        # succeeds, another process's attempt fails
+        lock_file = open(self.directory / f'worker-{worker}.lock', 'a')
+        try:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    async def append(self, records):
+        await asyncio.to_thread(self.write_records, records)
+
+    def write_records(self, records):
+        if self.file is None:
+            self.file = open(self.open_path, 'a', encoding='utf-8')
+        # Written through to the OS: a crashed process loses nothing
+        self.file.write(''.join(json.dumps(record) + '\n' for record in records))
+        self.file.flush()
+
+    async def seal(self):
+        if self.file is None:
+            return None
+        file, self.file = self.file, None
+        sealed = self.directory / f'worker-{self.worker}.{time.time_ns()}-{next(self.sequence)}.sealed'
+        # Renamed here so the next append starts a new segment; the slow
+        # part runs off the event loop
+        os.replace(self.open_path, sealed)
+        await asyncio.to_thread(self.close_segment, file)
+        return [sealed]
+
+    def close_segment(self, file):
+        os.fsync(file.fileno())
+        file.close()
+
+    async def ack(self, token):
+        for path in token:
+            path.unlink(missing_ok=True)
+
+    async def pending(self, all_workers=False):
+        '''
+        [(journal, token, records)] left unacknowledged by earlier runs, by
+        this worker or, with all_workers, by any.
+        '''
+        workers = [self.worker]
+        if all_workers:
+            names = {path.name.split('.', 1)[0][len('worker-'):] for path in self.directory.glob('worker-*.*')}
+            workers = [int(name) for name in names if name.isdigit()]
+        batches = []
+        for worker in sorted(workers):
+            prefix = f'worker-{worker}'
+            if worker != self.worker:
+                lock_file = self.lock(worker)
+                if lock_file is None:
+                    # A running process: its segments are its own
+                    continue
+                lock_file.close()
+            # Called before this journal appends anything, and the worker's
+            # lock is free, so open segments belong to processes that are gone
+            for path in self.directory.glob(f'{prefix}.open'):
+                os.replace(path, path.with_name(f'{path.stem}.{time.time_ns()}-recovered.sealed'))
+            for path in sorted(self.directory.glob(f'{prefix}.*.sealed')):
+                with open(path, encoding='utf-8') as f:
+                    records = [json.loads(line) for line in f if line.strip()]
+                batches.append((self, [path], records))
+        return batches
+
+
+class RedisJournal:
+    '''
+    One Redis stream per worker, chat:writebehind:<id>. Sealing hands the
+    flusher the entry ids appended so far; acking deletes them.
+    '''
+
+    def __init__(self, client, key):
+        self.client = client
+        self.key = key
+        self.ids = []
+
+    async def append(self, records):
+        async with self.client.pipeline(transaction=False) as pipe:
+            for record in records:
+                pipe.xadd(self.key, {'record': json.dumps(record)})
+            self.ids.extend(await pipe.execute())
+
+    async def seal(self):
+        ids, self.ids = self.ids, []
+        return ids or None
+
+    async def ack(self, token):
+        await self.client.xdel(self.key, *token)
+
+    async def pending(self, all_workers=False):
+        '''
+        [(journal, token, records)] left unacknowledged by earlier runs, by
+        this worker or, with all_workers, by any.
+        '''
+        journals = [self]
+        if all_workers:
+            journals = [
+                RedisJournal(self.client, key.decode())
+                async for key in self.client.scan_iter(match='chat:writebehind:*', _type='stream')
+            ]
+        batches = []
+        for journal in journals:
+            entries = await self.client.xrange(journal.key)
+            if entries:
+                batches.append((
+                    journal,
+                    [entry_id for entry_id, _ in entries],
+                    [json.loads(fields[b'record']) for _, fields in entries],
+                ))
+        return batches
+
+
+def get_journal(worker=None, recovering=False):
+    '''
+    The journal of worker (this process's by default). recovering with no
+    worker gives one that only replays other workers' journals.
+    '''
+    if worker is None and not recovering:
+        worker = worker_id()
+    if JOURNAL == 'redis':
+        return RedisJournal(redis.Redis.from_url(JOURNAL_REDIS_URL), f'chat:writebehind:{worker}')
+    return FileJournal(JOURNAL_DIR, worker)
+
+
+#----------------------
+#   Persisting
+#----------------------
+
+@db_batch
+def persist(records):
+    '''
+    INSERT a batch of journal records, skipping ids already stored, and
+    update their connections. Returns inbox entries for those connections.
+    '''
+    messages = [to_message(record) for record in records]
+    with transaction.atomic():
+        stored = set(Message.objects.filter(id__in=[m.id for m in messages]).values_list('id', flat=True))
+        # select_for_update keeps concurrent flushers' counter updates apart
+        connections = Connection.objects.select_for_update().in_bulk({m.connection_id for m in messages})
+        fresh = []
+        for message in messages:
+            if message.id in stored:
+                continue
+            if message.connection_id not in connections:
+                # Deleted since the message was accepted
+                logger.warning('dropping message for missing connection', extra={
+                    'message_id': message.id, 'connection_id': message.connection_id
+                })
+                continue
+            fresh.append(message)
+        Message.objects.bulk_create(fresh, batch_size=BATCH_SIZE)
+        if fresh:
+            # Past the snowflake ids, for inserts made with write-behind off
+            # (PostgreSQL; SQLite's AUTOINCREMENT already follows max(id))
+            database = transaction.get_connection()
+            with database.cursor() as cursor:
+                for sql in database.ops.sequence_reset_sql(no_style(), [Message]):
+                    cursor.execute(sql)
+
+        # What Message.save would have done per message, one UPDATE per connection
+        changed = {}
+        for message in sorted(fresh, key=lambda m: m.id):
+            connection = connections[message.connection_id]
+            connection.record_message(message)
+            changed[connection.pk] = connection
+        for connection in changed.values():
+            Connection.objects.filter(pk=connection.pk).update(
+                last_message_id=connection.last_message_id,
+                last_text=connection.last_text,
+                last_created=connection.last_created,
+                sender_last_read=connection.sender_last_read,
+                receiver_last_read=connection.receiver_last_read,
+                sender_unread=connection.sender_unread,
+                receiver_unread=connection.receiver_unread,
+            )
+    return [inbox.connection_entry(connection) for connection in changed.values()]
+
+
+async def persist_each(records):
+    '''
+    persist() one record at a time, after a batch failed on a bad row.
+    Rows the database rejects are logged and dropped (dead-lettered) so
+    they can't hold up the rest; other errors still fail the batch.
+    '''
+    entries = []
+    for record in records:
+        try:
+            entries += await persist([record])
+        except (IntegrityError, DataError):
+            logger.exception('dead-lettering message', extra={
+                'message_id': record['id'],
+                'connection_id': record['connection'],
+                'record': record,
+            })
+    return entries
+
+
+async def persist_and_ack(records, tokens):
+    '''
+    Commit records, then acknowledge the (journal, token) pairs holding them.
+    '''
+    try:
+        entries = await persist(records)
+    except (IntegrityError, DataError):
+        # e.g. the author was deleted after sending
+        entries = await persist_each(records)
+    for journal, token in tokens:
+        await journal.ack(token)
+    if inbox.enabled():
+        for entry in entries:
+            await inbox.safely(inbox.update(entry))
+
+
+async def recover(journal, all_workers=False):
+    '''
+    Replay unacknowledged journal batches; returns how many records.
+    '''
+    count = 0
+    for source, token, records in await journal.pending(all_workers):
+        await persist_and_ack(records, [(source, token)])
+        count += len(records)
+    return count
+
+
+class Writer:
+    '''
+    This process's unflushed messages and the task flushing them, for one
+    event loop.
+    '''
+
+    def __init__(self, journal):
+        self.journal = journal
+        self.buffer = []
+        # Sealed journal segments whose messages aren't committed yet
+        self.sealed = []
+        self.task = None
+        self.recovery = None
+        # Held from journaling a record to buffering it, and while sealing,
+        # so a flush seals exactly what's buffered
+        self.lock = asyncio.Lock()
+
+    def start(self):
+        '''
+        Replay what earlier runs left in the journal, in the background.
+        '''
+        if self.recovery is None:
+            self.recovery = asyncio.ensure_future(self.recover())
+            self.recovery.add_done_callback(self.recovered)
+
+    def recovered(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('message recovery failed', exc_info=task.exception())
+            # Tried again by the next socket or message
+            self.recovery = None
+
+    async def write(self, record):
+        '''
+        Journal a message and queue it for the next flush.
+        '''
+        self.start()
+        # New messages wait for older ones to be stored
+        await self.recovery
+        async with self.lock:
+            await self.journal.append([record])
+            self.buffer.append(record)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def recover(self):
+        count = await recover(self.journal)
+        if count:
+            logger.info('recovered messages', extra={'messages': count})
+
+    async def run(self):
+        while self.buffer:
+            if len(self.buffer) < BATCH_SIZE:
+                await asyncio.sleep(INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('message flush failed', extra={'messages': len(self.buffer)})
+                await asyncio.sleep(RETRY_DELAY)
+
+    async def flush(self):
+        async with self.lock:
+            if not self.buffer:
+                return
+            batch, self.buffer = self.buffer, []
+            token = await self.journal.seal()
+        if token is not None:
+            self.sealed.append((self.journal, token))
+        try:
+            await persist_and_ack(batch, self.sealed)
+        except Exception:
+            # Retried with whatever arrives meanwhile
+            self.buffer = batch + self.buffer
+            raise
+        self.sealed = []
+
+
+def writer():
+    '''
+    This event loop's Writer; creating it starts recovery.
+    '''
+    loop = asyncio.get_running_loop()
+    current = _writers.get(loop)
+    if current is None:
+        current = _writers[loop] = Writer(get_journal())
+        current.start()
+    return current
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -57,15 +58,137 @@ MEDIA_URL = '/media/'
 #Daphne 
 ASGI_APPLICATION = 'core.asgi.application'
 
+# Redis for shared chat state (caches, inbox, presence, offline queues,
+# write-behind journal), at databases 1-5. Every worker of a deployment
+# must point at the same one.
+CHAT_REDIS_URL = os.environ.get('CHAT_REDIS_URL', 'redis://127.0.0.1:6379').rstrip('/')
+
+# Channel layer shards: CHAT_LAYER_HOSTS is a comma-separated list of
+# Redis URLs, and user groups are spread over them by consistent hashing
+# (see chat.layers). CAPACITY is the undelivered messages a worker holds
+# before sends to it are dropped: all sockets of a process share one
+# channel key, so it bounds the worker's backlog, not one socket's.
+# EXPIRY is the seconds an undelivered message lives; GROUP_EXPIRY is the
+# seconds a socket stays in its group without reconnecting.
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'chat.layers.RedisChannelLayer',
         'CONFIG': {
-            'hosts': [('127.0.0.1', 6379)],
+            'hosts': os.environ.get('CHAT_LAYER_HOSTS', CHAT_REDIS_URL).split(','),
+            'capacity': int(os.environ.get('CHAT_LAYER_CAPACITY', 1000)),
+            'expiry': int(os.environ.get('CHAT_LAYER_EXPIRY', 60)),
+            'group_expiry': int(os.environ.get('CHAT_LAYER_GROUP_EXPIRY', 86400)),
         }
     },
 }
 
+#Chat
+# Max ORM batches in flight per process (see chat.db)
+CHAT_DB_CONCURRENCY = 8
+# message.list page size, and the most a client may ask for
+CHAT_MESSAGE_PAGE_SIZE = 30
+CHAT_MESSAGE_PAGE_SIZE_MAX = 100
+# Max users returned by a search
+CHAT_SEARCH_LIMIT = 20
+# Processes resizing avatars off the event loop (0 = use a thread)
+CHAT_IMAGE_WORKERS = 2
+CHAT_THUMBNAIL_QUALITY = 85
+# Largest avatar upload accepted over HTTP or the socket
+CHAT_UPLOAD_MAX_BYTES = 10 * 1024 * 1024
+# Frame codec: 'json', or 'orjson' when it's installed
+CHAT_JSON_CODEC = 'json'
+# Serialized profiles: per-process LRU size and TTL (seconds), in front
+# of the shared cache below
+CHAT_PROFILE_CACHE_SIZE = 10000
+CHAT_PROFILE_CACHE_TTL = 60
+CHAT_PROFILE_CACHE_ALIAS = 'profiles'
+# Friends and request lists kept in Redis (unset to read them from the DB),
+# and the seconds an idle user's lists live there
+CHAT_INBOX_REDIS_URL = f'{CHAT_REDIS_URL}/2'
+CHAT_INBOX_TTL = 3600
+# sync: newest messages sent per connection, and the seconds of overlap
+# applied to client watermarks
+CHAT_SYNC_MESSAGE_LIMIT = 100
+CHAT_SYNC_OVERLAP = 5
+# Presence: Redis shards for session sets (empty turns it off), session
+# TTL and heartbeat (seconds), and how long changes are merged before
+# friends are told
+CHAT_PRESENCE_REDIS_URLS = os.environ.get('CHAT_PRESENCE_REDIS_URLS', f'{CHAT_REDIS_URL}/3').split(',')
+CHAT_PRESENCE_TTL = 60
+CHAT_PRESENCE_HEARTBEAT = 20
+CHAT_PRESENCE_INTERVAL = 1.0
+# Queued message.send frames for offline users (see chat.offline); needs
+# presence. Each user's queue keeps about CHAT_OFFLINE_MAX_LENGTH frames
+CHAT_OFFLINE_REDIS_URL = f'{CHAT_REDIS_URL}/5'
+CHAT_OFFLINE_MAX_LENGTH = 1000
+CHAT_OFFLINE_TTL = 7 * 24 * 3600
+CHAT_OFFLINE_BATCH = 200
+# Seconds between typing events forwarded per conversation
+CHAT_TYPING_INTERVAL = 1.0
+# Write-behind message.send (see chat.writebehind), off unless
+# CHAT_WRITE_BEHIND=1. Journal: 'file' (CHAT_WRITE_BEHIND_DIR) or 'redis'.
+# A flush runs every CHAT_WRITE_BEHIND_INTERVAL seconds, or once
+# CHAT_WRITE_BEHIND_BATCH messages are waiting.
+CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', '0') == '1'
+CHAT_WRITE_BEHIND_JOURNAL = os.environ.get('CHAT_WRITE_BEHIND_JOURNAL', 'file')
+CHAT_WRITE_BEHIND_DIR = os.environ.get('CHAT_WRITE_BEHIND_DIR', BASE_DIR / 'journal')
+CHAT_WRITE_BEHIND_REDIS_URL = f'{CHAT_REDIS_URL}/4'
+CHAT_WRITE_BEHIND_BATCH = 500
+CHAT_WRITE_BEHIND_INTERVAL = 0.05
+# Snowflake worker id (0-63) for message ids; unique per worker process and
+# required with write-behind
+CHAT_WORKER_ID = int(os.environ['CHAT_WORKER_ID']) if os.environ.get('CHAT_WORKER_ID') else None
+# Messages older than CHAT_ARCHIVE_AFTER_DAYS move to gzip segments here
+# (manage.py archive_messages); kept out of MEDIA_ROOT so they aren't served
+CHAT_ARCHIVE_DIR = BASE_DIR / 'archive'
+CHAT_ARCHIVE_AFTER_DAYS = 90
+CHAT_ARCHIVE_SEGMENT_SIZE = 1000
+# Share of per-frame log records kept, and the handler time (ms) above
+# which a frame is always logged as slow
+CHAT_LOG_FRAME_SAMPLE_RATE = 0.01
+CHAT_LOG_SLOW_FRAME_MS = 250
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Shared chat Redis, its own database
+    'profiles': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': f'{CHAT_REDIS_URL}/1',
+        'TIMEOUT': 3600,
+    },
+}
+
+#Logging: JSON lines written from a background thread (see chat.log)
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'sample': {'()': 'chat.log.SampleFilter'},
+        'redact': {'()': 'chat.log.RedactFilter'},
+    },
+    'formatters': {
+        'json': {'()': 'chat.log.JSONFormatter'},
+    },
+    'handlers': {
+        'queue': {
+            # '()' rather than 'class': dictConfig would otherwise expect
+            # stdlib QueueHandler wiring (queue/handlers keys)
+            '()': 'chat.log.QueueHandler',
+            'filters': ['sample', 'redact'],
+            'formatter': 'json',
+        },
+    },
+    'loggers': {
+        'chat': {
+            'handlers': ['queue'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -100,11 +223,57 @@ WSGI_APPLICATION = 'core.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
+# CHAT_DB_PROFILE picks the backend:
+#   sqlite      the default file database
+#   sqlite-wal  WAL journal, IMMEDIATE write transactions and a busy
+#               timeout, so concurrent writers queue instead of failing
+#   postgres    PostgreSQL from POSTGRES_* variables, with a connection
+#               pool (or persistent connections when CHAT_DB_POOL=0)
+DB_PROFILE = os.environ.get('CHAT_DB_PROFILE', 'sqlite')
+# SQLite file (workers sharing one should use sqlite-wal)
+SQLITE_PATH = os.environ.get('CHAT_SQLITE_PATH', BASE_DIR / 'db.sqlite3')
+
+DATABASE_PROFILES = {
+    'sqlite': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': SQLITE_PATH,
+    },
+    'sqlite-wal': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': SQLITE_PATH,
+        'OPTIONS': {
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+            'transaction_mode': 'IMMEDIATE',
+            # Seconds a writer waits for the lock before 'database is locked'
+            'timeout': int(os.environ.get('CHAT_DB_BUSY_TIMEOUT', 20)),
+        },
+    },
+    'postgres': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('POSTGRES_DB', 'chat'),
+        'USER': os.environ.get('POSTGRES_USER', 'chat'),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': os.environ.get('POSTGRES_HOST', '127.0.0.1'),
+        'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+        'CONN_HEALTH_CHECKS': True,
+    },
+}
+
+if os.environ.get('CHAT_DB_POOL', '1') == '1':
+    # psycopg's pool, shared by the DB threads of one process; Django
+    # refuses CONN_MAX_AGE alongside it
+    DATABASE_PROFILES['postgres']['OPTIONS'] = {
+        'pool': {
+            'min_size': int(os.environ.get('CHAT_DB_POOL_MIN', 2)),
+            'max_size': int(os.environ.get('CHAT_DB_POOL_MAX', 10)),
+            'timeout': 10,
+        },
     }
+else:
+    DATABASE_PROFILES['postgres']['CONN_MAX_AGE'] = int(os.environ.get('CHAT_DB_CONN_MAX_AGE', 60))
+
+DATABASES = {
+    'default': DATABASE_PROFILES[DB_PROFILE],
 }
 
 